@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+
+"""
+Benchmark scans of generated trees, for comparing throughput and memory across commits.
+Each scenario generates the same tree from its seed, then times a full scan with hardlink.Search,
+recording phase timings and counters from the run metrics, and peak traced memory with --memory.
+"""
+
+import argparse, json, os, random, subprocess, sys, tempfile, time, tracemalloc
+import hardlink
+
+# file count, directory depth and fanout, (size, weight) distribution, and the fractions of files that are
+# duplicates, near-duplicates differing in the last byte, and extra links into existing clusters
+SCENARIOS = {
+    "flat": dict(files=10000, depth=0, fanout=1, sizes=[(1024, 1)], duplicates=0.5, near=0, clusters=0),
+    "deep": dict(files=10000, depth=6, fanout=3, sizes=[(1024, 1)], duplicates=0.5, near=0, clusters=0),
+    "mixed": dict(files=5000, depth=3, fanout=4, sizes=[(100, 4), (20000, 3), (1024 * 1024, 1)], duplicates=0.3,
+                  near=0.1, clusters=0.1),
+    "unique": dict(files=10000, depth=3, fanout=4, sizes=[(4096, 1), (65536, 1)], duplicates=0, near=0, clusters=0),
+    "near": dict(files=2000, depth=2, fanout=4, sizes=[(256 * 1024, 1)], duplicates=0.1, near=0.8, clusters=0),
+    "clusters": dict(files=10000, depth=3, fanout=4, sizes=[(1024, 1)], duplicates=0.3, near=0, clusters=0.4),
+}
+
+
+def generate(root, files, depth, fanout, sizes, duplicates, near, clusters, seed=0):
+    """Generate a tree of files, the same for the same parameters and seed."""
+    random_ = random.Random(seed)
+    directories = [root]
+    level = [root]
+    for _ in range(depth):
+        level = [os.path.join(directory, "d%i" % child) for directory in level for child in range(fanout)]
+        directories += level
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+    contents = []
+    paths = []
+    for number in range(files):
+        path = os.path.join(random_.choice(directories), "f%i" % number)
+        chance = random_.random()
+        if paths and chance < clusters:
+            os.link(random_.choice(paths), path)
+            continue
+        chance -= clusters
+        if contents and chance < duplicates:
+            data = random_.choice(contents)
+        elif contents and chance < duplicates + near:
+            data = random_.choice(contents)
+            data = data[:-1] + bytes([data[-1] ^ 1])
+        else:
+            size = random_.choices([size for size, _ in sizes], [weight for _, weight in sizes])[0]
+            data = random_.getrandbits(8 * size).to_bytes(size, "little")
+            contents.append(data)
+        with open(path, "wb") as file:
+            file.write(data)
+        os.utime(path, ns=(10 ** 18, 10 ** 18))
+        paths.append(path)
+
+
+def benchmark(name, parameters, seed, jobs, dry_run, memory, out_of_core=False, processes=1):
+    """Generate a scenario's tree and time a scan of it."""
+    with tempfile.TemporaryDirectory() as root:
+        generate(root, seed=seed, **parameters)
+        search = hardlink.Search([root], None, [], 0, 0, False, False, False, jobs, out_of_core=out_of_core,
+                                 processes=processes)
+        if memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        search.scan(0, dry_run, True)
+        seconds = time.perf_counter() - start
+        peak = None
+        if memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    metrics = search.metrics
+    return {"scenario": name, "parameters": parameters, "seed": seed, "jobs": jobs, "dry_run": dry_run,
+            "out_of_core": out_of_core, "processes": processes,
+            "seconds": round(seconds, 6), "files_per_second": round(metrics.counters["files"] / seconds, 1),
+            "peak_memory": peak, "timers": {name: round(seconds, 6) for name, seconds in metrics.timers.items()},
+            "counters": dict(metrics.counters)}
+
+
+def commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark hardlink.py scans of generated trees.")
+    parser.add_argument("scenarios", help="scenarios to run (default: all): " + ", ".join(SCENARIOS), nargs="*")
+    parser.add_argument("-j", "--jobs", type=int, help="workers (default: 1)", metavar="N", dest="jobs", default=1)
+    parser.add_argument("-J", "--processes", type=int, help="worker processes by size range (default: 1)", metavar="N",
+                        dest="processes", default=1)
+    parser.add_argument("-m", "--memory", help="trace peak memory (slower)", action="store_true", dest="memory",
+                        default=False)
+    parser.add_argument("-n", "--dry-run", help="scan without linking", action="store_true", dest="dry_run",
+                        default=False)
+    parser.add_argument("-O", "--out-of-core", help="scan in out-of-core mode", action="store_true",
+                        dest="out_of_core", default=False)
+    parser.add_argument("-o", "--output", help="JSON results file (default: stdout)", metavar="FILE",
+                        dest="output", default=None)
+    parser.add_argument("-r", "--repeat", type=int, help="runs of each scenario (default: 1)", metavar="N",
+                        dest="repeat", default=1)
+    parser.add_argument("-s", "--scale", type=float, help="multiply file counts (default: 1)", metavar="FACTOR",
+                        dest="scale", default=1)
+    parser.add_argument("--seed", type=int, help="tree generator seed (default: 0)", dest="seed", default=0)
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            print("ERROR: unknown scenario %s" % name)
+            sys.exit(1)
+    results = []
+    for name in args.scenarios or SCENARIOS:
+        parameters = dict(SCENARIOS[name], files=max(1, int(SCENARIOS[name]["files"] * args.scale)))
+        for _ in range(args.repeat):
+            result = benchmark(name, parameters, args.seed, args.jobs, args.dry_run, args.memory, args.out_of_core,
+                               args.processes)
+            print("%-10s %10.3fs %12.1f files/s" % (name, result["seconds"], result["files_per_second"]),
+                  file=sys.stderr)
+            results.append(result)
+    text = json.dumps({"commit": commit(), "python": sys.version.split()[0], "time": time.time(),
+                       "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
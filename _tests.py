@@ -7,9 +7,15 @@ Added skip()
 """
 
 import os
+import re
 import sys
 import tempfile
 import time
+import json
+import io
+import contextlib
+import glob
+import threading
 import unittest
 import hardlink
 
@@ -71,6 +77,19 @@ class OriginalTests(unittest.TestCase):
             self.assertEqual(os.lstat("dir1/name3.ext").st_ino, os.lstat("dir3/name1.ext").st_ino)
             self.assertEqual(os.lstat("dir1/name1.ext").st_ino, os.lstat("dir4/name1.ext").st_ino)
 
+    #@unittest.skip("")
+    def test_hardlink_tree_jobs(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.create_temporary_files(root)
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-q", "--jobs", "4", root]
+            hardlink.main()
+            self.verify_file_contents()
+            self.assertEqual(os.lstat("dir1/name1.ext").st_ino, os.lstat("dir1/name2.ext").st_ino)
+            self.assertEqual(os.lstat("dir1/name1.ext").st_ino, os.lstat("dir2/name1.ext").st_ino)
+            self.assertEqual(os.lstat("dir1/name1.ext").st_ino, os.lstat("dir3/name1.noext").st_ino)
+            self.assertEqual(os.lstat("dir1/name3.ext").st_ino, os.lstat("dir3/name1.ext").st_ino)
+            self.assertEqual(os.lstat("dir1/name1.ext").st_ino, os.lstat("dir4/name1.ext").st_ino)
+
     #@unittest.skip("")
     def test_hardlink_tree_filenames_equal(self):
         with tempfile.TemporaryDirectory() as root:
@@ -97,6 +116,22 @@ class OriginalTests(unittest.TestCase):
             self.assertEqual(os.lstat("dir1/name3.ext").st_ino, os.lstat("dir3/name1.ext").st_ino)
             self.assertEqual(os.lstat("dir1/name1.ext").st_ino, os.lstat("dir4/name1.ext").st_ino)
 
+    #@unittest.skip("")
+    def test_hardlink_tree_exclude_from(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.create_temporary_files(root)
+            with open(root + "/ignore", "w") as f:
+                f.write("# comment\n*.noext\ndir2/\n")
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-q", "--exclude", "dir[4]", "--exclude", r"(name)\1",
+                        "--exclude-from", root + "/ignore", root]
+            hardlink.main()
+            self.verify_file_contents()
+            self.assertEqual(os.lstat("dir1/name1.ext").st_ino, os.lstat("dir1/name2.ext").st_ino)
+            self.assertNotEqual(os.lstat("dir1/name1.ext").st_ino, os.lstat("dir2/name1.ext").st_ino)
+            self.assertNotEqual(os.lstat("dir1/name1.ext").st_ino, os.lstat("dir3/name1.noext").st_ino)
+            self.assertEqual(os.lstat("dir1/name3.ext").st_ino, os.lstat("dir3/name1.ext").st_ino)
+            self.assertNotEqual(os.lstat("dir1/name1.ext").st_ino, os.lstat("dir4/name1.ext").st_ino)
+
     #@unittest.skip("")
     def test_hardlink_tree_timestamp(self):
         with tempfile.TemporaryDirectory() as root:
@@ -168,6 +203,62 @@ class ClusterTests(unittest.TestCase):
             self.assertEqual(os.lstat("1a").st_ino, os.lstat("2d").st_ino)
             self.assertEqual(os.lstat("1a").st_ino, os.lstat("2e").st_ino)
 
+    #@unittest.skip("")
+    def test_hardlink_clusters(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.create_files(root)
+            # clusters of 3 and 20 links, and a link to the smallest listed last
+            for cluster, links in (("3", 3), ("4", 20)):
+                with open(cluster + "a", "w") as f:
+                    f.write(self.files["1a"])
+                for link in range(1, links):
+                    os.link(cluster + "a", "%s%02i" % (cluster, link))
+            os.mkdir("z")
+            os.link("1a", "z/1z")
+            reports = []
+            for dry_run in (["-n"], []):
+                sys.argv = ["hardlink.py", "-Y", "-v", "0"] + dry_run + [root]
+                with contextlib.redirect_stdout(io.StringIO()) as output:
+                    hardlink.main()
+                reports.append(output.getvalue().split("Run Time")[0])
+            self.assertEqual(reports[0], reports[1]) # dry run predicts the run
+            self.assertIn("Files:\t\t31\n", reports[1])
+            self.assertIn("Inodes:\t\t1\n", reports[1])
+            self.verify_file_contents()
+            inodes = {os.lstat(os.path.join(directory, filename)).st_ino
+                      for directory, _, filenames in os.walk(root) for filename in filenames}
+            self.assertEqual(len(inodes), 1)
+            self.assertEqual(os.lstat("1a").st_nlink, 31)
+
+    #@unittest.skip("")
+    def test_hardlink_clusters_depth_first(self):
+        results = []
+        for arguments in ([], ["-j", "4", "-D"]):
+            with tempfile.TemporaryDirectory() as root:
+                self.create_files(root)
+                # clusters spread across directories, listed in a different order by each worker
+                for directory in ("x", "x/y", "z"):
+                    os.mkdir(directory)
+                    for cluster, links in (("1", 2), ("5", 3)):
+                        with open("%s/%sa" % (directory, cluster), "w") as f:
+                            f.write(self.files["1a"] if cluster == "1" else self.files["1a"] + directory)
+                        for link in range(1, links):
+                            os.link("%s/%sa" % (directory, cluster), "%s/%s%02i" % (directory, cluster, link))
+                os.link("1a", "z/1z")
+                sys.argv = ["hardlink.py", "-Y", "-v", "1", "-o"] + arguments + [root]
+                with contextlib.redirect_stdout(io.StringIO()) as output:
+                    hardlink.main()
+                self.verify_file_contents()
+                inodes = {}
+                for directory, _, filenames in os.walk(root):
+                    for filename in filenames:
+                        path = os.path.join(directory, filename)
+                        inodes.setdefault(os.lstat(path).st_ino, set()).add(os.path.relpath(path, root))
+                results.append((re.sub(r"Inode [0-9]+", "Inode", output.getvalue().replace(root, "")
+                                       .split("Run Time")[0]), sorted(sorted(paths) for paths in inodes.values())))
+        self.assertEqual(results[0][0], results[1][0]) # same links made, in the same order, and statistics
+        self.assertEqual(results[0][1], results[1][1])
+
     def tearDown(self):
         pass
 
@@ -214,6 +305,524 @@ class BasicTests(unittest.TestCase):
             self.assertEqual(os.lstat("a/A1").st_mtime, self.now) # latest attributes
             self.assertEqual(os.lstat("b/E2").st_mtime, self.now) # latest attributes
 
+    #@unittest.skip("")
+    def test_persistent_database(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.create_files(root)
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-q", "-d", root + "/a"]
+            hardlink.main()
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-q", "-d", root + "/b"]
+            hardlink.main()
+            self.verify_file_contents()
+            self.assertEqual(os.lstat("a/A1").st_ino, os.lstat("b/D1").st_ino)
+            self.assertEqual(os.lstat("a/C2").st_ino, os.lstat("b/E2").st_ino)
+            self.assertEqual(os.lstat("b/F3").st_ino, os.lstat("b/G3").st_ino)
+
+    #@unittest.skip("")
+    def test_persistent_database_dry_run(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.chdir(root)
+            contents = "abcdefghijklmnopqrstuvwxyz" * 1024
+            for filename, age in (("x", 10), ("y", 20)):
+                with open(filename, "w") as f:
+                    f.write(contents)
+                os.utime(filename, (time.time() - age, time.time() - age))
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-q", "-d", "-n", root]
+            hardlink.main()
+            # links only planned are not recorded
+            with open("y", "w") as f:
+                f.write(contents[::-1])
+            with open("w", "w") as f:
+                f.write(contents)
+            os.link("w", "w2")
+            os.link("w", "w3")
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-q", "-d", root]
+            hardlink.main()
+            with open("y") as f:
+                self.assertEqual(f.read(), contents[::-1])
+            self.assertEqual(os.lstat("x").st_ino, os.lstat("w").st_ino)
+            self.assertNotEqual(os.lstat("y").st_ino, os.lstat("w").st_ino)
+
+    #@unittest.skip("")
+    def test_incremental(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.create_files(root)
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-q", "-d", "-i", root]
+            hardlink.main()
+            os.mkdir("c")
+            with open("c/D1", "w") as f:
+                f.write(self.files["b/D1"])
+            hardlink.main()
+            self.verify_file_contents()
+            self.assertEqual(os.lstat("a/A1").st_ino, os.lstat("c/D1").st_ino)
+            self.assertEqual(os.lstat("a/C2").st_ino, os.lstat("b/E2").st_ino)
+
+    #@unittest.skip("")
+    def test_incremental_options(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.create_files(root)
+            # directories are not recorded in a dry run
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-q", "-d", "-i", "-n", root]
+            hardlink.main()
+            # nor skipped where recorded with other options
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-q", "-d", "-i", "-m", "*3", root]
+            hardlink.main()
+            self.assertNotEqual(os.lstat("a/A1").st_ino, os.lstat("b/D1").st_ino)
+            self.assertEqual(os.lstat("b/F3").st_ino, os.lstat("b/G3").st_ino)
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-q", "-d", "-i", root]
+            hardlink.main()
+            self.verify_file_contents()
+            self.assertEqual(os.lstat("a/A1").st_ino, os.lstat("b/D1").st_ino)
+            self.assertEqual(os.lstat("a/C2").st_ino, os.lstat("b/E2").st_ino)
+
+    #@unittest.skip("")
+    def test_plan_apply(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.create_files(root)
+            # excluding only the plan itself, not paths containing its name
+            sys.argv = ["hardlink.py", "-v", "0", "-q", "--plan", "A", root]
+            hardlink.main()
+            self.assertNotEqual(os.lstat("a/A1").st_ino, os.lstat("a/B1").st_ino)
+            os.utime("b/F3", (self.now + 1, self.now + 1))
+            sys.argv = ["hardlink.py", "-v", "0", "-q", "--apply", "A"]
+            hardlink.main()
+            self.verify_file_contents()
+            self.assertEqual(os.lstat("a/A1").st_ino, os.lstat("b/D1").st_ino)
+            self.assertEqual(os.lstat("a/C2").st_ino, os.lstat("b/E2").st_ino)
+            self.assertNotEqual(os.lstat("b/F3").st_ino, os.lstat("b/G3").st_ino) # changed since planned
+
+    #@unittest.skip("")
+    def test_leftover_temporary_links(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.create_files(root)
+            os.link("a/A1", "a/A1" + hardlink.TEMPORARY_SUFFIX)
+            with open("hardlink.journal", "wb") as journal:
+                journal.write(os.fsencode(root + "/a/A1" + hardlink.TEMPORARY_SUFFIX) + b"\0")
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-q", root]
+            hardlink.main()
+            self.verify_file_contents()
+            self.assertFalse(os.path.exists("a/A1" + hardlink.TEMPORARY_SUFFIX))
+            self.assertFalse(os.path.exists("hardlink.journal"))
+            self.assertEqual(os.lstat("a/A1").st_ino, os.lstat("b/D1").st_ino)
+
+    #@unittest.skip("")
+    def test_link_same_inode(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.create_files(root)
+            os.link("a/A1", "a/A1b")
+            with hardlink.Linker(root + "/hardlink.journal") as linker:
+                self.assertTrue(linker.link(root + "/a/A1", root + "/a/A1b"))
+                self.assertEqual(linker.links, 0)
+                self.assertTrue(linker.link(root + "/a/A1", root + "/b/D1"))
+                self.assertEqual(linker.links, 1)
+            self.assertFalse(os.path.exists("a/A1b" + hardlink.TEMPORARY_SUFFIX))
+            self.assertFalse(os.path.exists("hardlink.journal"))
+            self.assertEqual(os.lstat("a/A1").st_nlink, 3)
+
+    #@unittest.skip("")
+    def test_link_failure(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.create_files(root)
+            # no room for the temporary name
+            long_name = "a/" + "L" * 250
+            with open(long_name, "w") as f:
+                f.write(self.files["a/A1"])
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", root]
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                hardlink.main()
+            self.assertIn("ERROR: Failed to hardlink", output.getvalue())
+            self.assertIn("STATISTICS", output.getvalue())
+            self.verify_file_contents()
+            self.assertEqual(os.lstat(long_name).st_nlink, 1)
+            self.assertEqual(os.lstat("a/A1").st_ino, os.lstat("b/D1").st_ino)
+            self.assertEqual(os.lstat("a/C2").st_ino, os.lstat("b/E2").st_ino)
+            self.assertEqual(os.lstat("b/F3").st_ino, os.lstat("b/G3").st_ino)
+
+    #@unittest.skip("")
+    def test_metrics(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.create_files(root)
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-q", "--metrics", "metrics.json", root + "/a", root + "/b"]
+            hardlink.main()
+            with open("metrics.json") as f:
+                metrics = json.load(f)
+            self.assertEqual(metrics["counters"]["directories"], 2)
+            self.assertEqual(metrics["counters"]["entries"], 8)
+            self.assertEqual(metrics["counters"]["links_created"], 4)
+            self.assertGreater(metrics["counters"]["bytes_read"], 0)
+            self.assertIn("linking", metrics["timers"])
+
+    #@unittest.skip("")
+    def test_lockstep_confirmed(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.chdir(root)
+            contents = os.urandom(1024 * 1024)
+            for number in range(10):
+                with open("L%d" % number, "wb") as f:
+                    f.write(contents)
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-q", "--metrics", "metrics.json", root]
+            hardlink.main()
+            with open("metrics.json") as f:
+                metrics = json.load(f)
+            self.assertEqual(metrics["counters"]["links_created"], 9)
+            self.assertEqual(metrics["counters"]["lockstep_comparisons"], 1)
+            self.assertNotIn("byte_comparisons", metrics["counters"])
+            self.assertEqual(len({os.lstat("L%d" % number).st_ino for number in range(10)}), 1)
+
+    #@unittest.skip("")
+    def test_events(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.create_files(root)
+            # excluding only the events file itself, not paths containing its name
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-q", "--events", "D", root]
+            hardlink.main()
+            with open("D") as f:
+                events = [json.loads(line) for line in f]
+            linked = [event for event in events if event["event"] == "linked"]
+            existing = [event["path"] for event in events if event["event"] == "existing"]
+            self.assertEqual(len(linked), 4)
+            self.assertEqual(sum(event["saved"] for event in linked),
+                             sum(len(self.files[filename]) for filename in ("a/B1", "b/D1", "b/E2", "b/G3")))
+            self.assertEqual(sorted(existing), [root + "/b/F3", root + "/b/h3"])
+            for event in linked:
+                self.assertEqual(os.lstat(event["path"]).st_ino, event["inode"])
+
+    #@unittest.skip("")
+    def test_events_stdout(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.create_files(root)
+            sys.argv = ["hardlink.py", "-Y", "-v", "1", "--events", "-", root]
+            with contextlib.redirect_stderr(io.StringIO()) as errors:
+                with contextlib.redirect_stdout(io.StringIO()) as output:
+                    hardlink.main()
+            events = [json.loads(line) for line in output.getvalue().splitlines()]
+            self.assertEqual(len([event for event in events if event["event"] == "linked"]), 4)
+            self.assertIn("Linked:", errors.getvalue())
+            self.assertIn("Added Links:\t4\n", errors.getvalue())
+
+    #@unittest.skip("")
+    def test_statistics(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.create_files(root)
+            reports = []
+            for dry_run in (["-n"], []):
+                sys.argv = ["hardlink.py", "-Y", "-v", "0"] + dry_run + [root]
+                with contextlib.redirect_stdout(io.StringIO()) as output:
+                    hardlink.main()
+                reports.append(output.getvalue().split("Run Time")[0])
+            self.assertEqual(reports[0], reports[1]) # dry run predicts the run
+            self.assertIn("Already Linked:\t1\n", reports[1])
+            self.assertIn("Added Links:\t4\n", reports[1])
+            self.assertIn("Files:\t\t8\n", reports[1])
+            self.assertIn("Inodes:\t\t3\n", reports[1])
+
+    #@unittest.skip("")
+    def test_out_of_core(self):
+        spill_records = hardlink.SPILL_RECORDS
+        hardlink.SPILL_RECORDS = 2
+        try:
+            with tempfile.TemporaryDirectory() as root:
+                self.create_files(root)
+                sys.argv = ["hardlink.py", "-Y", "-v", "0", "-q", "-O", "-d", "-i", root]
+                hardlink.main()
+                self.verify_file_contents()
+                self.assertEqual(os.lstat("a/A1").st_ino, os.lstat("b/D1").st_ino)
+                self.assertEqual(os.lstat("a/C2").st_ino, os.lstat("b/E2").st_ino)
+                self.assertEqual(os.lstat("b/F3").st_ino, os.lstat("b/G3").st_ino)
+                os.mkdir("c")
+                with open("c/D1", "w") as f:
+                    f.write(self.files["b/D1"])
+                hardlink.main()
+                self.assertEqual(os.lstat("a/A1").st_ino, os.lstat("c/D1").st_ino)
+        finally:
+            hardlink.SPILL_RECORDS = spill_records
+
+    #@unittest.skip("")
+    def test_out_of_core_release(self):
+        with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as other:
+            self.create_files(root)
+            db_filename = other + "/hardlink.db"
+            for run in range(3):
+                search = hardlink.Search([root], None, [], 0, 0, False, False, False, incremental=True,
+                                         out_of_core=True)
+                search.database.load(db_filename)
+                with search.linker:
+                    search.scan(0, False, True)
+                search.database.save(db_filename)
+                if run == 0:
+                    # nothing held of the sizes processed
+                    self.assertEqual(search.database.fingerprints, {})
+                    self.assertEqual(search.database.tally.linked, set())
+                    self.assertEqual(search.database.tally.already_links, 1)
+            self.assertEqual(os.lstat("a/A1").st_ino, os.lstat("b/D1").st_ino)
+            # directory records held on disk until their files were processed, then written
+            self.assertEqual(search.metrics.counters["directories_unchanged"], 3)
+
+    #@unittest.skip("")
+    def test_processes(self):
+        shard_files = hardlink.SHARD_FILES
+        hardlink.SHARD_FILES = 2
+        try:
+            with tempfile.TemporaryDirectory() as root:
+                self.create_files(root)
+                reports = []
+                for arguments in (["-n"], ["-J", "2", "-n"], ["-J", "2", "--metrics", "metrics.json"]):
+                    sys.argv = ["hardlink.py", "-Y", "-v", "0", "-o"] + arguments + [root]
+                    with contextlib.redirect_stdout(io.StringIO()) as output:
+                        hardlink.main()
+                    reports.append(output.getvalue().split("Run Time")[0])
+                self.assertEqual(reports[0].split("STATISTICS")[1], reports[1].split("STATISTICS")[1])
+                self.assertEqual(reports[1], reports[2]) # merged reports, predicted by the dry run
+                self.verify_file_contents()
+                self.assertEqual(os.lstat("a/A1").st_ino, os.lstat("b/D1").st_ino)
+                self.assertEqual(os.lstat("a/C2").st_ino, os.lstat("b/E2").st_ino)
+                self.assertEqual(os.lstat("b/F3").st_ino, os.lstat("b/G3").st_ino)
+                with open("metrics.json") as f:
+                    metrics = json.load(f)
+                self.assertEqual(metrics["counters"]["links_created"], 4)
+                self.assertEqual(glob.glob("hardlink.journal*"), [])
+        finally:
+            hardlink.SHARD_FILES = shard_files
+
+    #@unittest.skip("")
+    def test_spill_devices(self):
+        if not os.path.isdir("/dev/shm") or os.lstat("/dev/shm").st_dev == os.lstat(tempfile.gettempdir()).st_dev:
+            self.skipTest("needs a second filesystem")
+        with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory(dir="/dev/shm") as other:
+            spill = hardlink.Spill()
+            try:
+                for directory in (root, other):
+                    for size in (1, 2, 2, 3):
+                        filename = tempfile.mktemp(dir=directory)
+                        with open(filename, "w") as f:
+                            f.write("x" * size)
+                        spill.add(hardlink.File(filename, os.lstat(filename)))
+                    spill.write_run()
+                shards = list(spill.shards(2))
+            finally:
+                spill.close()
+            # each shard of one device, the devices in turn
+            devices = [{os.path.dirname(path) for size, paths in shard for path in paths} for shard in shards]
+            self.assertCountEqual(devices[:2], [{root}, {other}])
+            self.assertEqual(devices[2:], devices[:2])
+            self.assertEqual([[size for size, paths in shard] for shard in shards], [[1, 2], [1, 2], [3], [3]])
+
+    #@unittest.skip("")
+    def test_sparse_files(self):
+        size = 16 * 1024 * 1024
+        with tempfile.TemporaryDirectory() as root:
+            os.chdir(root)
+            for filename, tail, sparse in (("S1", b"y", True), ("S2", b"y", True), ("S3", b"y", False),
+                                           ("S4", b"z", True)):
+                with open(filename, "wb") as f:
+                    f.write(b"x" * 5000)
+                    if sparse:
+                        f.seek(size - 5000)
+                    else:
+                        f.write(bytes(size - 10000))
+                    f.write(tail * 5000)
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-q", root]
+            hardlink.main()
+            self.assertEqual(os.lstat("S1").st_ino, os.lstat("S2").st_ino)
+            self.assertEqual(os.lstat("S1").st_ino, os.lstat("S3").st_ino) # zeros written where the others have holes
+            self.assertNotEqual(os.lstat("S1").st_ino, os.lstat("S4").st_ino)
+            with open("S1", "rb") as f:
+                self.assertEqual(f.read(), b"x" * 5000 + bytes(size - 10000) + b"y" * 5000)
+            self.assertEqual(hardlink.compare_files("S1", "S4")[0], False)
+            if os.lstat("S4").st_blocks * 512 < size: # holes supported
+                self.assertLess(hardlink.compare_files("S4", "S4")[1], size)
+
+    #@unittest.skip("")
+    def test_checkpoint_resume(self):
+        save = hardlink.Checkpoint.save
+        saved = []
+
+        def interrupt(checkpoint, search, directories, dry_run=False):
+            save(checkpoint, search, directories, dry_run)
+            saved.append(directories)
+            if len(saved) == 2:
+                raise KeyboardInterrupt
+
+        with tempfile.TemporaryDirectory() as root:
+            self.create_files(root)
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-c", "0", root]
+            hardlink.Checkpoint.save = interrupt
+            try:
+                with self.assertRaises(KeyboardInterrupt):
+                    hardlink.main()
+            finally:
+                hardlink.Checkpoint.save = save
+            self.assertEqual(len(saved[1]), 1) # one directory left
+            self.assertTrue(os.path.exists("hardlink.checkpoint"))
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-r", "-f", root]
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                with self.assertRaises(SystemExit):
+                    hardlink.main()
+            self.assertIn("other directories or options", output.getvalue())
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-r", root]
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                hardlink.main()
+            self.verify_file_contents()
+            self.assertEqual(os.lstat("a/A1").st_ino, os.lstat("b/D1").st_ino)
+            self.assertEqual(os.lstat("a/C2").st_ino, os.lstat("b/E2").st_ino)
+            self.assertEqual(os.lstat("b/F3").st_ino, os.lstat("b/G3").st_ino)
+            self.assertIn("Added Links:\t4\n", output.getvalue())
+            self.assertIn("Files:\t\t8\n", output.getvalue())
+            self.assertIn("Inodes:\t\t3\n", output.getvalue())
+            self.assertFalse(os.path.exists("hardlink.checkpoint"))
+
+    #@unittest.skip("")
+    def test_checkpoint_resume_stale(self):
+        save = hardlink.Checkpoint.save
+        saved = []
+
+        def interrupt(checkpoint, search, directories, dry_run=False):
+            # interrupted after linking, before the next checkpoint is written
+            saved.append(directories)
+            if len(saved) == 2:
+                raise KeyboardInterrupt
+            save(checkpoint, search, directories, dry_run)
+
+        with tempfile.TemporaryDirectory() as root:
+            os.chdir(root)
+            os.mkdir("b")
+            for filename in ("A1", "b/B1"):
+                with open(filename, "w") as f:
+                    f.write("abcdefghijklmnopqrstuvwxyz" * 1024)
+            os.link("b/B1", "b/B2")
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-q", "-c", "0", root]
+            hardlink.Checkpoint.save = interrupt
+            try:
+                with self.assertRaises(KeyboardInterrupt):
+                    hardlink.main()
+            finally:
+                hardlink.Checkpoint.save = save
+            self.assertEqual(os.lstat("A1").st_ino, os.lstat("b/B1").st_ino)
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-q", "-r", root]
+            hardlink.main()
+            self.assertEqual(os.lstat("A1").st_ino, os.lstat("b/B1").st_ino)
+            self.assertEqual(os.lstat("A1").st_nlink, 3)
+            self.assertEqual([filename for filename in os.listdir(root) + os.listdir("b")
+                              if filename.endswith(hardlink.TEMPORARY_SUFFIX)], [])
+
+    #@unittest.skip("")
+    def test_physical_order(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.create_files(root)
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-q", "-R", "-d", "-i", "--metrics", "metrics.json", root]
+            hardlink.main()
+            self.verify_file_contents()
+            self.assertEqual(os.lstat("a/A1").st_ino, os.lstat("b/D1").st_ino)
+            self.assertEqual(os.lstat("a/C2").st_ino, os.lstat("b/E2").st_ino)
+            self.assertEqual(os.lstat("b/F3").st_ino, os.lstat("b/G3").st_ino)
+            with open("metrics.json") as f:
+                metrics = json.load(f)
+            self.assertEqual(metrics["counters"]["links_created"], 4)
+            os.mkdir("c")
+            with open("c/D1", "w") as f:
+                f.write(self.files["b/D1"])
+            hardlink.main()
+            self.assertEqual(os.lstat("a/A1").st_ino, os.lstat("c/D1").st_ino)
+
+    #@unittest.skip("")
+    def test_library(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.create_files(root)
+            database = hardlink.Database()
+            events = [event["event"] for event in hardlink.scan([root], dry_run=True, database=database)]
+            self.assertEqual(events.count("planned"), 4)
+            self.assertNotEqual(os.lstat("a/A1").st_ino, os.lstat("b/D1").st_ino)
+            events = [event["event"] for event in hardlink.scan([root], database=database)]
+            self.assertEqual(events.count("linked"), 4)
+            self.assertNotIn("planned", events)
+            self.verify_file_contents()
+            self.assertEqual(os.lstat("a/A1").st_ino, os.lstat("b/D1").st_ino)
+            self.assertEqual(os.lstat("b/F3").st_ino, os.lstat("b/G3").st_ino)
+            # files unchanged since are not read again
+            os.mkdir("c")
+            with open("c/D1", "w") as f:
+                f.write(self.files["b/D1"])
+            events = [event for event in hardlink.scan([root], database=database) if event["event"] == "linked"]
+            self.assertEqual([event["path"] for event in events], [root + "/c/D1"])
+            self.assertEqual(database.metrics.counters["sample_digests"], 1)
+            self.assertEqual(os.lstat("a/A1").st_ino, os.lstat("c/D1").st_ino)
+
+    #@unittest.skip("")
+    def test_digest_cache(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.create_files(root)
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-q", "-C", "-n", root]
+            hardlink.main()
+            with self.assertRaises(OSError):
+                os.getxattr("a/A1", hardlink.DIGEST_ATTRIBUTE)
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-q", "-C", root]
+            hardlink.main()
+            self.assertEqual(os.lstat("a/A1").st_ino, os.lstat("b/D1").st_ino)
+            self.assertIsNotNone(os.getxattr("b/F3", hardlink.DIGEST_ATTRIBUTE))
+            # only the new file is read
+            os.mkdir("c")
+            with open("c/D1", "w") as f:
+                f.write(self.files["b/D1"])
+            sys.argv = ["hardlink.py", "-Y", "-v", "0", "-q", "-C", "--metrics", "metrics.json", root]
+            hardlink.main()
+            with open("metrics.json") as f:
+                metrics = json.load(f)
+            self.assertEqual(metrics["counters"]["sample_digests"], 1)
+            self.assertEqual(metrics["counters"]["attribute_hits"], 2)
+            self.verify_file_contents()
+            self.assertEqual(os.lstat("a/A1").st_ino, os.lstat("c/D1").st_ino)
+            # changed contents are read again
+            with open("b/F3", "r+") as f:
+                f.write("0")
+            hardlink.main()
+            with open("metrics.json") as f:
+                metrics = json.load(f)
+            self.assertEqual(metrics["counters"]["attribute_misses"], 1)
+
+    #@unittest.skip("")
+    def test_watch(self):
+        watch_delay = hardlink.WATCH_DELAY
+        hardlink.WATCH_DELAY = 0.1
+        try:
+            with tempfile.TemporaryDirectory() as root:
+                self.create_files(root)
+                search = hardlink.Search([root], None, [], 0, 0, False, False, False, watcher=hardlink.Watcher())
+                search.scan(0, False, True)
+                self.assertEqual(os.lstat("a/A1").st_ino, os.lstat("b/D1").st_ino)
+                already_links = search.database.tally.already_links
+                thread = threading.Thread(target=search.watch)
+                thread.start()
+                try:
+                    with open("a/H1", "w") as f:
+                        f.write(self.files["a/A1"])
+                    os.mkdir("c")
+                    with open("c/I3", "w") as f:
+                        f.write(self.files["b/F3"])
+                    # not while still open for writing
+                    with open("a/J1", "w") as f:
+                        f.write(self.files["a/A1"])
+                        f.flush()
+                        time.sleep(5 * hardlink.WATCH_DELAY)
+                        self.assertNotEqual(os.lstat("a/J1").st_ino, os.lstat("a/A1").st_ino)
+                    for _ in range(100):
+                        if os.lstat("a/H1").st_ino == os.lstat("a/A1").st_ino \
+                                and os.lstat("c/I3").st_ino == os.lstat("b/F3").st_ino \
+                                and os.lstat("a/J1").st_ino == os.lstat("a/A1").st_ino:
+                            break
+                        time.sleep(0.05)
+                finally:
+                    search.stopped = True
+                    thread.join()
+                search.linker.close()
+                self.verify_file_contents()
+                self.assertEqual(os.lstat("a/H1").st_ino, os.lstat("a/A1").st_ino)
+                self.assertEqual(os.lstat("c/I3").st_ino, os.lstat("b/F3").st_ino)
+                self.assertEqual(os.lstat("a/J1").st_ino, os.lstat("a/A1").st_ino)
+                # the links made are not found again as files moved in
+                self.assertEqual(search.database.tally.already_links, already_links)
+        finally:
+            hardlink.WATCH_DELAY = watch_delay
+
     def tearDown(self):
         pass
 
@@ -16,31 +16,103 @@ persistent database file option for efficient data collection on dry-run passes
 with correct statistics for dry-run scans.
 """
 
-import subprocess, sys, os, re, time, fnmatch, filecmp, argparse, logging, pickle
+import subprocess, sys, os, re, time, fnmatch, argparse, logging, hashlib, concurrent.futures, \
+    collections, array, sqlite3, json, contextlib, csv, struct, tempfile, heapq, itertools, fcntl, errno, \
+    queue, threading, ctypes, select, stat, glob, bisect, pickle
+
+# bytes read from each of the head, middle and tail of a file for the sample digest
+SAMPLE_SIZE = 4096
+# read size for full content digests
+CHUNK_SIZE = 1024 * 1024
+# new files processed together, hashed ahead in parallel with --jobs
+BATCH_SIZE = 1024
+# changes held before writing through to the persistent database
+FLUSH_SIZE = 1000
+# files compared together in lockstep, and their total read buffer
+LOCKSTEP_FILES = 256
+LOCKSTEP_BUFFER = 64 * 1024 * 1024
+# maximum links assumed where a filesystem does not report PC_LINK_MAX (ext3)
+DEFAULT_LINK_MAX = 32000
+# file records sorted in memory before spilling a run to disk in out-of-core mode
+SPILL_RECORDS = 250000
+# files handed to a worker process at once in sharded mode, as a range of whole file sizes
+SHARD_FILES = 10000
+# seconds between checkpoints of a scan by default
+CHECKPOINT_INTERVAL = 300
+# directory descriptors held open for linking
+DIRECTORY_DESCRIPTORS = 64
+# suffix of the temporary link renamed over each replaced file
+TEMPORARY_SUFFIX = ".$$$___cleanit___$$$"
+# FIEMAP ioctl (linux/fiemap.h), its struct fiemap header, and the size of one struct fiemap_extent
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = "=QQIIII"
+FIEMAP_EXTENT_SIZE = 56
+# inotify events (linux/inotify.h): files closed after writing or moved in, directories created or moved in, a
+# watched directory moved, and a watch removed or the event queue overflowed
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_EXCL_UNLINK = 0x4000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+# directories watched at most, seconds events are coalesced for before acting on them, and bytes of events read
+# at once
+WATCH_DIRECTORIES = 65536
+WATCH_DELAY = 1.0
+WATCH_BUFFER = 64 * 1024
+# extended attribute holding an inode's digests, and its header of the size and modification time they were
+# computed at
+DIGEST_ATTRIBUTE = "user.hardlink.blake2b"
+DIGEST_HEADER = "=qq"
+
+
+def packed(index):
+    """Property for a number packed into an object's values array."""
+    return property(lambda self: self.values[index], lambda self, value: self.values.__setitem__(index, value))
 
 
 class File:
-    """Defines an file inode object based on os.scandir() DirEntry"""
-
-    def __init__(self, directory_entry):
-        self.inodes = [directory_entry.stat().st_ino]
-        self.device = directory_entry.stat().st_dev
-        self.size = directory_entry.stat().st_size
-        self.time = directory_entry.stat().st_mtime
-        self.access_time = directory_entry.stat().st_atime
-        self.mode = directory_entry.stat().st_mode
-        self.uid = directory_entry.stat().st_uid
-        self.gid = directory_entry.stat().st_gid
-        self.path = directory_entry.path
-        self.name = directory_entry.name
-        self.links = directory_entry.stat().st_nlink
-        # record of original filenames, inode, links, current links and new links
-        self.files = {self.path: (directory_entry.stat().st_ino, self.links, 0)}
-
-    def hardlink(self, other, dry_run=False, verbose=0):
+    """Defines an file inode object based on os.scandir() DirEntry or os.lstat() status"""
+
+    __slots__ = ("path", "filenames", "values")
+
+    # status fields packed ahead of the filename records in the values array
+    device = packed(0)
+    size = packed(1)
+    time_ns = packed(2)
+    access_time_ns = packed(3)
+    mode = packed(4)
+    uid = packed(5)
+    gid = packed(6)
+    links = packed(7)
+    change_time_ns = packed(8)
+    RECORDS = 9
+
+    def __init__(self, path, status):
+        self.path = path
+        # other filenames, as a list or, for larger clusters, a dict of positions
+        self.filenames = None
+        # status, then records of original inode, original links and new links for each filename
+        self.values = array.array("q", (status.st_dev, status.st_size, status.st_mtime_ns, status.st_atime_ns,
+                                        status.st_mode, status.st_uid, status.st_gid, status.st_nlink,
+                                        status.st_ctime_ns,
+                                        signed(status.st_ino), status.st_nlink, 0))
+
+    def hardlink(self, other, dry_run=False, verbose=0, plan=None, linker=None, events=None, statistics=None):
         """Hardlink two inodes together, keeping latest attributes. Backtrack through any unlinked files. Returns updated source file object and any cleared file object."""
+        if linker is None and not dry_run:
+            with Linker() as linker:
+                return self.hardlink(other, dry_run, verbose, plan, linker, events, statistics)
         # use the file with most hardlinks as source
-        linked_inodes = []
+        # filenames relinked so far from each original inode
+        linked_inodes = {}
+        # paths are only cleaned up for the debug log where it is written
+        debugging = logging.getLogger().isEnabledFor(logging.DEBUG)
         if other.links > self.links:
             logging.debug("BACKTRACKING")
             source = other
@@ -50,100 +122,125 @@ class File:
             source = self
             destination = other
             redundant = False
+        if plan is not None:
+            plan.write(source, destination)
+        if statistics is not None:
+            remaining = statistics.links(destination, dry_run)
         for filename in destination.files:
-            # attempt file rename
-            temporary_name = filename + ".$$$___cleanit___$$$"
-            try:
-                if not dry_run:
-                    os.rename(filename, temporary_name)
-            except OSError as error:
-                print("\nERROR: Failed to rename: %s to %s: %s" % (filename, temporary_name, error))
-                continue
-            else:
-                # attempt hardlink
+            if not dry_run:
+                if debugging:
+                    logging.debug("HARDLINKING %s %s", strip_invalid_characters(source.path),
+                                  strip_invalid_characters(filename))
                 try:
-                    if not dry_run:
-                        logging.debug(
-                            "HARDLINKING " + strip_invalid_characters(source.path) + " " + strip_invalid_characters(
-                                filename))
-                        os.link(source.path, filename)
-                except Exception as error:
+                    if not linker.link(source.path, filename):
+                        continue
+                except OSError as error:
                     print("\nERROR: Failed to hardlink: %s to %s: %s" % (
                         strip_invalid_characters(source.path), strip_invalid_characters(filename), error))
-                    # attempt recovery
-                    try:
-                        os.rename(temporary_name, filename)
-                    except Exception as error:
-                        print("\nALERT: Failed to rename back %s to %s: %s" % (temporary_name, filename, error))
-                    return False, False
+                    if events is not None:
+                        events.error(filename, error)
+                    # the file is untouched
+                    continue
+            # hardlink succeeded
+            if debugging:
+                logging.debug("SOURCE %s %i", strip_invalid_characters(source.path), source.links)
+                logging.debug("DESTINATION %s %i", strip_invalid_characters(filename),
+                              destination.original_links(filename))
+            # adjust link counts for repeated inodes
+            inode = destination.original_inode(filename)
+            if inode in linked_inodes:
+                destination.decrement_links(filename, linked_inodes[inode])
+            linked_inodes[inode] = linked_inodes.get(inode, 0) + 1
+            # update file links
+            source.new_filename(filename, destination.original_inode(filename),
+                                destination.original_links(filename),
+                                source.links - destination.total_links(filename) + 1)
+            source.increment_links(source.path)
+            # update to latest attributes, written once for the inode by the linker
+            if destination.time_ns > source.time_ns:
+                source.time_ns = destination.time_ns
+                source.uid = destination.uid
+                source.gid = destination.gid
+                if not dry_run:
+                    source.access_time_ns = destination.access_time_ns
+                    linker.update(source)
+            if statistics is not None:
+                statistics.relinked(destination, filename, remaining, dry_run)
+                remaining -= 1
+            if events is not None:
+                events.link(source, destination, filename, dry_run)
+            if verbose >= 1:
+                if dry_run:
+                    print("\nDry Run: ", end="")
                 else:
-                    # hardlink succeeded
-                    logging.debug("SOURCE " + strip_invalid_characters(source.path) + " " + str(source.links))
-                    logging.debug("DESTINATION " + strip_invalid_characters(filename) + " " + str(
-                        destination.original_links(filename)))
-                    # adjust link counts for repeated inodes
-                    inode = destination.original_inode(filename)
-                    if inode in linked_inodes:
-                        destination.decrement_links(filename, linked_inodes.count(inode))
-                    linked_inodes.append(inode)
-                    # update file links
-                    source.new_filename(filename, destination.original_inode(filename),
-                                        destination.original_links(filename),
-                                        source.links - destination.total_links(filename) + 1)
-                    source.increment_links(source.path)
-                    # update to latest attributes
-                    if destination.time > source.time:
-                        try:
-                            if not dry_run:
-                                os.chown(filename, destination.uid, destination.gid)
-                                os.utime(filename, (destination.access_time, destination.time))
-                                source.access_time = destination.access_time
-                        except Exception as error:
-                            print("\nERROR: Failed to update file attributes: %s" % error)
-                        else:
-                            source.time = destination.time
-                            source.uid = destination.uid
-                            source.gid = destination.gid
-                    # delete temporary file
-                    if not dry_run:
-                        os.unlink(temporary_name)
-                    if verbose >= 1:
-                        if dry_run:
-                            print("\nDry Run: ", end="")
-                        else:
-                            print("\n Linked: ", end="")
-                        print("%s (%i links)" % (source.path, source.links - 1))
-                        print("     to: %s (%i links)" % (filename, destination.total_links(filename)))
-                        print("         %s saved" % human(
-                            destination.size if destination.total_links(filename) == 1 else 0))
+                    print("\n Linked: ", end="")
+                print("%s (%i links)" % (source.path, source.links - 1))
+                print("     to: %s (%i links)" % (filename, destination.total_links(filename)))
+                print("         %s saved" % human(
+                    destination.size if destination.total_links(filename) == 1 else 0))
+        if not dry_run:
+            # the destination inode is replaced, with any attributes queued for it
+            linker.discard(destination)
         return source, redundant
 
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+    @property
+    def time(self):
+        return self.time_ns / 1e9
+
+    @property
+    def files(self):
+        """Original filenames."""
+        return self.filenames or (self.path,)
+
     def new_filename(self, filename, inode, links, new):
+        """Record a filename, or update its record. Returns True for a new filename."""
         if new:
             self.links += 1
-        self.files.update({filename: (inode, links, new)})
-        if inode not in self.inodes:
-            self.inodes.append(inode)
+        added = False
+        try:
+            position = self.position(filename)
+        except (KeyError, ValueError):
+            added = True
+            if self.filenames is None:
+                self.filenames = [self.path, filename]
+            elif isinstance(self.filenames, list):
+                self.filenames.append(filename)
+                if len(self.filenames) > 8:
+                    self.filenames = {filename: position for position, filename in enumerate(self.filenames)}
+            else:
+                self.filenames[filename] = len(self.filenames)
+            self.values.extend((signed(inode), links, new))
+        else:
+            self.values[position:position + 3] = array.array("q", (signed(inode), links, new))
+        return added
 
     def increment_links(self, filename):
-        self.files[filename] = (
-            self.original_inode(filename), self.original_links(filename), self.new_links(filename) + 1)
+        self.values[self.position(filename) + 2] += 1
 
     def decrement_links(self, filename, links):
-        self.files[filename] = (
-            self.original_inode(filename), self.original_links(filename) - links, self.new_links(filename))
+        self.values[self.position(filename) + 1] = self.original_links(filename) - links
+
+    def position(self, filename):
+        """Offset of the filename's record in the values array."""
+        if isinstance(self.filenames, dict):
+            return self.RECORDS + 3 * self.filenames[filename]
+        return self.RECORDS + 3 * self.files.index(filename)
 
     def inode(self):
-        return self.inodes[0]
+        return unsigned(self.values[self.RECORDS])
 
     def original_inode(self, filename):
-        return self.files[filename][0]
+        return unsigned(self.values[self.position(filename)])
 
     def original_links(self, filename):
-        return self.files[filename][1]
+        return self.values[self.position(filename) + 1]
 
     def new_links(self, filename):
-        return self.files[filename][2]
+        return self.values[self.position(filename) + 2]
 
     def total_links(self, filename):
         return self.new_links(filename) + self.original_links(filename)
@@ -155,21 +252,178 @@ class File:
         return self.hardlink(other)
 
 
+class Metrics:
+    """Defines run counters and phase timers, written as JSON with --metrics."""
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        # seconds spent in each phase
+        self.timers = collections.Counter()
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[name] += time.perf_counter() - start
+
+    def merge(self, other):
+        """Add the counters and timers of another process, timers summed across processes."""
+        self.counters.update(other.counters)
+        self.timers.update(other.timers)
+
+    def save(self, filename):
+        with open(filename, "w") as file:
+            json.dump({"counters": dict(self.counters),
+                       "timers": {name: round(seconds, 6) for name, seconds in self.timers.items()}},
+                      file, indent=2, sort_keys=True)
+            file.write("\n")
+
+
+class Statistics:
+    """Defines the run statistics, counted as files are found, added to the database and linked."""
+
+    def __init__(self):
+        self.inodes = 0
+        self.files = 0
+        self.already_links = 0
+        self.saved_already = 0
+        self.updated_links = 0
+        self.added_links = 0
+        self.saved_bytes = 0
+        # inodes found with more than one link
+        self.linked = set()
+        # links moved off each inode in a dry run, where link counts on the device don't change
+        self.moved = {}
+
+    def found(self, file):
+        """Count a file found by the scan as already linked where another link to its inode was found before,
+        even when linking has since left it the last."""
+        if (file.device, file.inode()) in self.linked:
+            self.already_links += 1
+            self.saved_already += file.size
+        elif file.links > 1:
+            self.linked.add((file.device, file.inode()))
+
+    def added(self, file):
+        """Count a new inode and its filenames in the database."""
+        self.inodes += 1
+        self.files += len(file.files)
+
+    def links(self, file, dry_run=False):
+        """Links to a file's inode, less those already moved off it in a dry run."""
+        if dry_run:
+            return file.links - self.moved.get((file.device, file.inode()), 0)
+        return file.links
+
+    def relinked(self, destination, filename, remaining, dry_run=False):
+        """Count a filename moved off the destination inode, which had the remaining links: an added link saving
+        the inode when it was the last, otherwise an updated link."""
+        if remaining == 1:
+            self.added_links += 1
+            self.saved_bytes += destination.size
+        else:
+            self.updated_links += 1
+        if dry_run and destination.original_inode(filename) == destination.inode():
+            key = (destination.device, destination.inode())
+            self.moved[key] = self.moved.get(key, 0) + 1
+
+    def merge(self, other):
+        """Add the statistics of other inodes."""
+        self.inodes += other.inodes
+        self.files += other.files
+        self.already_links += other.already_links
+        self.saved_already += other.saved_already
+        self.updated_links += other.updated_links
+        self.added_links += other.added_links
+        self.saved_bytes += other.saved_bytes
+        self.linked.update(other.linked)
+        self.moved.update(other.moved)
+
+    def release(self):
+        """Drop the inodes of the sizes processed, which an inode, having one size, is not found again after."""
+        self.linked.clear()
+        self.moved.clear()
+
+
+class Clusters:
+    """Defines the inodes known identical this run, by device and inode, as a disjoint-set forest: merging two
+    clusters takes near constant time whatever their size."""
+
+    def __init__(self):
+        # parent of each inode merged under another, and the size of each cluster by its root
+        self.parents = {}
+        self.sizes = {}
+
+    def find(self, key):
+        """Root of an inode's cluster, halving the path to it."""
+        parents = self.parents
+        while key in parents:
+            parent = parents[key]
+            if parent in parents:
+                parents[key] = parents[parent]
+            key = parent
+        return key
+
+    def union(self, key, other):
+        """Merge the clusters of two inodes, the smaller under the larger. Returns the root."""
+        key = self.find(key)
+        other = self.find(other)
+        if key == other:
+            return key
+        if self.sizes.get(key, 1) < self.sizes.get(other, 1):
+            key, other = other, key
+        self.parents[other] = key
+        self.sizes[key] = self.sizes.get(key, 1) + self.sizes.pop(other, 1)
+        return key
+
+    def clear(self):
+        self.parents.clear()
+        self.sizes.clear()
+
+
 class Database:
     """Defines the file database: fingerprints, inodes, and filenames and link counts."""
 
     def __init__(self):
         self.start_time = time.time()
         self.skipped = 0
+        self.metrics = Metrics()
+        self.tally = Statistics()
         self.fingerprints = {}
+        # content digests known this run: (device, inode) -> [sample digest, full digest]
+        self.digests = {}
+        # content index: fingerprint -> constraints -> sample digest -> full digest -> file,
+        # with files not yet hashed listed under None
+        self.index = {}
+        # lockstep comparison each inode took part in this batch: (device, inode) -> run
+        self.runs = {}
+        # persistent database
+        self.store = None
+        # fingerprints released from memory in out-of-core mode
+        self.released = 0
+        # kept in memory for reuse across runs, with the change times of linked files kept current
+        self.retained = False
+        # digests cached in extended attributes
+        self.attributes = None
+        # file sizes loaded from the persistent database
+        self.loaded = set()
+        # inodes given links only planned in a dry run, kept out of the persistent database
+        self.planned = set()
+
+    def __getstate__(self):
+        """Pickled for a checkpoint or from a worker process, without the persistent database connection."""
+        state = self.__dict__.copy()
+        state["store"] = None
+        return state
 
     def text_dump(self):
         """Text dump from database. For debugging, development and testing."""
         text = "\n"
         for fingerprint in self.fingerprints:
             text += "\n +-" + str(fingerprint)
-            for inode in self.fingerprints[fingerprint]:
-                file = self.fingerprints[fingerprint][inode]
+            for inode, file in self.bucket(fingerprint).items():
                 text += "\n\n    " + str(inode) + " " + time.ctime(file.time) + " - " + str(file.links)
                 for filename in file.files:
                     text += "\n       " + str(file.original_inode(filename)) + " " + strip_invalid_characters(
@@ -177,284 +431,1951 @@ class Database:
                         file.new_links(filename)) + "\n"
         return text + "\n"
 
+    def release(self):
+        """Drop the files held in memory, counting their fingerprints for the statistics."""
+        self.released += len(self.fingerprints)
+        self.fingerprints.clear()
+        self.index.clear()
+        self.digests.clear()
+        self.tally.release()
+        if self.attributes:
+            self.attributes.read.clear()
+
+    def merge(self, other):
+        """Add the statistics, metrics and files of a database of other file sizes."""
+        self.tally.merge(other.tally)
+        self.metrics.merge(other.metrics)
+        self.skipped += other.skipped
+        self.released += other.released
+        self.fingerprints.update(other.fingerprints)
+
+    def renew(self, fingerprint):
+        """Start another run in the same process, keeping the files unchanged on disk since the last run and
+        dropping any changed since, or left with links that were only planned in a dry run."""
+        self.retained = True
+        self.start_time = time.time()
+        self.skipped = 0
+        self.released = 0
+        self.metrics = Metrics()
+        self.tally = Statistics()
+        if self.store:
+            self.store.metrics = self.metrics
+        if self.attributes:
+            self.attributes.metrics = self.metrics
+            self.attributes.read.clear()
+        files = [file for files in self.fingerprints.values()
+                 for file in ((files,) if isinstance(files, File) else files.values())]
+        digests = dict(self.digests)
+        self.fingerprints.clear()
+        self.digests.clear()
+        self.index.clear()
+        self.runs.clear()
+        for file in files:
+            if not self.unchanged(file):
+                continue
+            self.fingerprints.setdefault(fingerprint(file), {})
+            self.insert(file, fingerprint(file))
+            self.tally.added(file)
+            if (file.device, file.inode()) in digests:
+                self.digests[(file.device, file.inode())] = digests[(file.device, file.inode())]
+
+    def validate(self, fingerprint):
+        """Drop the files of a fingerprint changed on disk since they were recorded, in a long-running scan.
+        Returns the files dropped."""
+        stale = [file for file in self.bucket(fingerprint).values() if not self.unchanged(file)]
+        for file in stale:
+            logging.debug("STALE INODE %i", file.inode())
+            self.forget(file)
+            self.tally.files -= len(file.files)
+            if isinstance(self.fingerprints[fingerprint], File):
+                del self.fingerprints[fingerprint]
+                self.tally.inodes -= 1
+                if self.store:
+                    self.store.remove(file)
+            else:
+                self.delete(file, fingerprint)
+        if stale:
+            self.index.pop(fingerprint, None)
+        return stale
+
+    def unchanged(self, file):
+        """Whether a file's inode still has the status recorded, links included."""
+        self.metrics.counters["stat_calls"] += 1
+        try:
+            status = os.lstat(file.path)
+        except OSError:
+            return False
+        return (status.st_dev, status.st_ino, status.st_size, status.st_mtime_ns, status.st_ctime_ns,
+                status.st_nlink) == (file.device, file.inode(), file.size, file.time_ns, file.change_time_ns,
+                                     file.links)
+
     def load(self, filename):
-        if os.path.isfile(filename):
-            self.fingerprints = pickle.load(open(filename, "rb"))
+        """Open the persistent database, to be loaded lazily by file size."""
+        self.store = Store(filename, self.digests, self.metrics, self.loaded)
+
+    def load_size(self, size, fingerprint):
+        """Load the known, still valid, inodes of a file size from the persistent database."""
+        if self.store:
+            for file in self.store.load(size):
+                self.fingerprints.setdefault(fingerprint(file), {})
+                self.insert(file, fingerprint(file))
+                self.tally.added(file)
 
     def save(self, filename):
-        # clear list of known compared inodes this run
-        for fingerprint in self.fingerprints:
-            for inode in self.fingerprints[fingerprint]:
-                self.fingerprints[fingerprint][inode].inodes = self.fingerprints[fingerprint][inode].inode()
-        pickle.dump(self.fingerprints, open(filename, "wb"))
+        """Write outstanding changes to the persistent database and close it."""
+        if self.store:
+            self.store.flush()
+            self.store.close()
+            self.store = None
 
     def new_fingerprint(self, file, fingerprint):
-        logging.debug("NEW FINGERPRINT " + str(fingerprint))
+        logging.debug("NEW FINGERPRINT %s", fingerprint)
         self.fingerprints[fingerprint] = {}
         self.new_file(file, fingerprint)
 
     def new_file(self, file, fingerprint):
-        logging.debug("NEW FILE " + str(fingerprint) + " " + str(file.inode()))
-        self.fingerprints[fingerprint].update({(file.device, file.inode()): file})
-        if logging.getLogger().level == logging.DEBUG:
-            logging.debug(self.text_dump())
+        logging.debug("NEW FILE %s %i", fingerprint, file.inode())
+        self.insert(file, fingerprint)
+        self.tally.added(file)
+        if self.store and (file.device, file.inode()) not in self.planned:
+            self.store.write(file)
 
     def update(self, file, fingerprint):
-        logging.debug("UPDATE INODE " + str(file.inode()))
-        self.fingerprints[fingerprint][(file.device, file.inode())] = file
-        if logging.getLogger().level == logging.DEBUG:
-            logging.debug(self.text_dump())
+        logging.debug("UPDATE INODE %i", file.inode())
+        self.insert(file, fingerprint)
+        if self.store and (file.device, file.inode()) not in self.planned:
+            self.store.write(file)
+
+    def plan(self, file):
+        """Keep a file given links only planned in a dry run out of the persistent database, which records the
+        filenames of each inode as they are on disk."""
+        self.planned.add((file.device, file.inode()))
+        if self.store:
+            self.store.changes.pop((file.device, file.inode()), None)
 
     def delete(self, file, fingerprint):
-        logging.debug("DELETE INODE " + str(file.inode))
-        del self.fingerprints[fingerprint][(file.device, file.inode())]
-        if logging.getLogger().level == logging.DEBUG:
-            logging.debug(self.text_dump())
+        logging.debug("DELETE INODE %i", file.inode())
+        files = self.fingerprints[fingerprint]
+        del files[(file.device, file.inode())]
+        self.tally.inodes -= 1
+        if len(files) == 1:
+            self.fingerprints[fingerprint] = next(iter(files.values()))
+        if self.store:
+            self.store.remove(file)
+
+    def insert(self, file, fingerprint):
+        """Add or replace a file in its bucket. Buckets of a single file hold the file itself, not a dict."""
+        files = self.fingerprints[fingerprint]
+        if not files or isinstance(files, File) and (files.device, files.inode()) == (file.device, file.inode()):
+            self.fingerprints[fingerprint] = file
+        else:
+            if isinstance(files, File):
+                files = self.fingerprints[fingerprint] = {(files.device, files.inode()): files}
+            files[(file.device, file.inode())] = file
+
+    def bucket(self, fingerprint):
+        """Files with a fingerprint, by (device, inode)."""
+        files = self.fingerprints.get(fingerprint, {})
+        if isinstance(files, File):
+            return {(files.device, files.inode()): files}
+        return files
 
     def lookup(self, fingerprint, inode):
-        return self.fingerprints[fingerprint][inode]
+        return self.bucket(fingerprint)[inode]
+
+    def forget(self, file):
+        """Drop the digests cached for a file's inode."""
+        self.digests.pop((file.device, file.inode()), None)
+        if self.attributes:
+            self.attributes.read.discard((file.device, file.inode()))
+
+    def recall(self, file):
+        """Cache the digests of an inode from its attribute, before reading it."""
+        if self.attributes and (file.device, file.inode()) not in self.digests:
+            self.attributes.recall(file, self.digests)
+
+    def cached_digests(self, file):
+        return self.digests.get((file.device, file.inode()), (None, None))
+
+    def cache_digest(self, file, stage, digest):
+        digests = self.digests.setdefault((file.device, file.inode()), [None, None])
+        digests[stage] = digest
+        # small files are sampled whole
+        if stage == 0 and file.size <= 3 * SAMPLE_SIZE:
+            digests[1] = digest
+        elif stage == 1 and self.attributes:
+            self.attributes.pending[(file.device, file.inode())] = file
+
+    def sample_digest(self, file):
+        """Cached digest of the head, middle and tail of an inode."""
+        self.recall(file)
+        if self.cached_digests(file)[0] is None:
+            self.cache_digest(file, 0, sample_digest(file.path, file.size))
+            self.metrics.counters["sample_digests"] += 1
+            self.metrics.counters["bytes_read"] += min(file.size, 3 * SAMPLE_SIZE)
+        else:
+            self.metrics.counters["digest_cache_hits"] += 1
+        return self.cached_digests(file)[0]
+
+    def content_digest(self, file):
+        """Cached digest of the full contents of an inode, read at most once per run."""
+        self.recall(file)
+        if self.cached_digests(file)[1] is None:
+            self.cache_digest(file, 1, content_digest(file.path))
+            self.metrics.counters["content_digests"] += 1
+            self.metrics.counters["bytes_read"] += file.size
+        else:
+            self.metrics.counters["digest_cache_hits"] += 1
+        return self.cached_digests(file)[1]
+
+    def index_file(self, file, fingerprint, constraints, replace=False):
+        """Add a file to the content index under whichever of its digests are known."""
+        digests = self.cached_digests(file)
+        level = self.index.setdefault(fingerprint, {}).setdefault(constraints, {}).setdefault(digests[0], {})
+        if digests[0] is None or digests[1] is None:
+            level.setdefault(None, []).append(file)
+        elif replace or digests[1] not in level:
+            level[digests[1]] = file
+
+    def match(self, file, fingerprint, constraints):
+        """Find the indexed file with the same contents, hashing only where there are candidates."""
+        samples = self.index.setdefault(fingerprint, {}).setdefault(constraints, {})
+        if not samples:
+            return None
+        for unsampled in samples.pop(None, {}).pop(None, []):
+            self.sample_digest(unsampled)
+            self.index_file(unsampled, fingerprint, constraints)
+        digests = samples.get(self.sample_digest(file))
+        if not digests:
+            return None
+        # compared in lockstep with, and different from, every file with the same sample digest
+        run = self.runs.get((file.device, file.inode()))
+        if run is not None and self.cached_digests(file)[1] is None \
+                and all(self.runs.get((known_file.device, known_file.inode())) is run
+                        for known_file in digests.get(None, []) + [known_file for digest, known_file in digests.items()
+                                                                   if digest is not None]):
+            return None
+        for unhashed in digests.pop(None, []):
+            self.content_digest(unhashed)
+            self.index_file(unhashed, fingerprint, constraints)
+        return digests.get(self.content_digest(file))
+
+    def compared_in_lockstep(self, file, known_file):
+        """Whether two inodes finished a lockstep comparison this batch still together, so are identical."""
+        run = self.runs.get((file.device, file.inode()))
+        return run is not None and self.runs.get((known_file.device, known_file.inode())) is run \
+            and self.cached_digests(file)[1] is not None \
+            and self.cached_digests(file)[1] == self.cached_digests(known_file)[1]
 
     def report_linked(self):
+        """Text listing previously hardlinked files, by inode, generated in parts."""
         inodes = {}
         for fingerprint in self.fingerprints:
-            for inode in self.fingerprints[fingerprint]:
-                file = self.fingerprints[fingerprint][inode]
+            for file in self.bucket(fingerprint).values():
                 for filename in file.files:
                     if file.original_links(filename) > 1:
                         if file.original_inode(filename) in inodes.keys():
                             inodes[file.original_inode(filename)][1].append(filename)
                         else:
                             inodes.update({file.original_inode(filename): (file.size, [filename])})
-        text = ""
+        if not inodes:
+            yield "\nNO FILES ALREADY HARDLINKED"
+            return
+        yield "\nALREADY HARDLINKED"
         for inode in sorted(inodes.keys()):
-            text += "\n\nInode " + str(inode) + " (" + human(inodes[inode][0]) + ") Linked:"
+            yield "\n\nInode " + str(inode) + " (" + human(inodes[inode][0]) + ") Linked:"
             for filename in sorted(inodes[inode][1]):
-                text += "\n  " + str(filename)
-        if text != "":
-            text = "\nALREADY HARDLINKED" + text
-        else:
-            text = "\nNO FILES ALREADY HARDLINKED"
-        return text
+                yield "\n  " + str(filename)
 
     def report_links(self):
-        text = ""
+        """Text listing files hardlinked this run, by inode, generated in parts."""
+        header = "\nHARDLINKED"
         for fingerprint in sorted(self.fingerprints.keys()):
-            for inode in sorted(self.fingerprints[fingerprint].keys()):
-                file = self.fingerprints[fingerprint][inode]
+            for inode in sorted(self.bucket(fingerprint).keys()):
+                file = self.lookup(fingerprint, inode)
                 if file.new_links(file.path) > 0:
-                    text += "\n\nInode " + str(file.inode()) + " (" + human(
-                        file.size) + ") Linked:\n"
-                    text += "  " + file.path
-                    for link in sorted(file.files.keys()):
-                        if file.new_links(link) > 0 and link != \
-                                file.path:
-                            text += "\n "
-                            if file.original_links(link) == 1:
-                                text += "+"
-                            else:
-                                text += " "
-                            text += link
+                    if header:
+                        yield header
+                        header = None
+                    yield "\n\nInode " + str(file.inode()) + " (" + human(file.size) + ") Linked:\n"
+                    yield "  " + file.path
+                    for link in sorted(file.files):
+                        if file.new_links(link) > 0 and link != file.path:
+                            yield "\n " + ("+" if file.original_links(link) == 1 else " ") + link
                     break
-        if text != "":
-            text = "\nHARDLINKED" + text
-        else:
-            text = "\nNO FILES HARDLINKED"
-        return text
-
-    def statistics(self, dry_run=False):
-        fingerprint_count = len(self.fingerprints)
-        inode_count = 0
-        file_count = 0
-        already_links = 0
-        added_links = 0
-        updated_links = 0
-        total_saved_bytes = 0
-        total_saved_already = 0
-        for fingerprint in self.fingerprints:
-            inode_count += len(self.fingerprints[fingerprint])
-            for inode in self.fingerprints[fingerprint]:
-                file = self.fingerprints[fingerprint][inode]
-                links_tally = {}
-                saved_already = 0
-                saved_bytes = 0
-                size = file.size
-                for filename in file.files:
-                    original_inode = file.original_inode(filename)
-                    original_links = file.original_links(filename)
-                    new_links = file.new_links(filename)
-                    file_count += 1
-                    if new_links > 0:
-                        if original_links > 1:
-                            updated_links += 1
-                        elif original_inode != \
-                                file.inode():
-                            saved_bytes += size
-                            added_links += 1
-                    if original_links > 1:
-                        saved_already += size
-                        already_links += 1
-                    # adjust statistics for dry run - as link counts don't actually get updated on the device
-                    if dry_run and original_inode != file.inode():
-                        if original_inode not in links_tally:
-                            links_tally.update({original_inode: (1, original_links, original_links)})
-                        else:
-                            links_tally.update({original_inode: (
-                                links_tally[original_inode][0] + 1, min(original_links, links_tally[original_inode][1]),
-                                max(original_links, links_tally[original_inode][2]))})
-                if dry_run:
-                    for inode in links_tally:
-                        if links_tally[inode][0] == links_tally[inode][2] and links_tally[inode][0] > 1:
-                            updated_links -= 1
-                            already_links -= 1
-                            added_links += 1
-                            saved_bytes += size
-                            saved_already -= size
-                if saved_already:
-                    total_saved_already += saved_already - size
-                if already_links:
-                    already_links -= 1
-                total_saved_bytes += saved_bytes
+        if header:
+            yield "\nNO FILES HARDLINKED"
+
+    def statistics(self):
+        tally = self.tally
         run_time = round((time.time() - self.start_time), 3)
-        return "\nSTATISTICS\n\nInodes:\t\t" + str(inode_count) + "\nFiles:\t\t" + str(
-            file_count) + "\nFingerprints:\t" + str(fingerprint_count) + "\nAlready Linked:\t" + str(
-            already_links) + "\nSaved Already:\t" + str(
-            human(total_saved_already) + "\nSkipped:\t" + str(self.skipped) + "\nUpdated Links:\t" + str(
-                updated_links) + "\nAdded Links:\t" + str(added_links) + "\nSaved Bytes:\t" + str(
-                human(total_saved_bytes)) + "\nRun Time:\t" + str(run_time) + "s\n")
+        return "\nSTATISTICS\n\nInodes:\t\t" + str(tally.inodes) + "\nFiles:\t\t" + str(
+            tally.files) + "\nFingerprints:\t" + str(len(self.fingerprints) + self.released) + "\nAlready Linked:\t" + str(
+            tally.already_links) + "\nSaved Already:\t" + str(
+            human(tally.saved_already) + "\nSkipped:\t" + str(self.skipped) + "\nUpdated Links:\t" + str(
+                tally.updated_links) + "\nAdded Links:\t" + str(tally.added_links) + "\nSaved Bytes:\t" + str(
+                human(tally.saved_bytes)) + "\nRun Time:\t" + str(run_time) + "s\n")
+
+
+class Store:
+    """Persistent SQLite database of known inodes, with their filenames and digests, loaded one file size at a time.
+    Entries are validated against the size, modification time and change time of the inode when loaded."""
+
+    def __init__(self, filename, digests, metrics, loaded=None):
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS inodes (device INTEGER, inode INTEGER, size INTEGER, time_ns INTEGER, "
+            "change_time_ns INTEGER, path BLOB, filenames BLOB, records BLOB, sample BLOB, digest BLOB, "
+            "PRIMARY KEY (device, inode))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS inodes_size ON inodes (size)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS directories (path BLOB PRIMARY KEY, time_ns INTEGER, change_time_ns INTEGER, "
+            "subdirectories BLOB, files INTEGER, options TEXT)")
+        self.digests = digests
+        self.metrics = metrics
+        self.loaded = set() if loaded is None else loaded
+        # changes not yet written: (device, inode) -> file, or None to delete
+        self.changes = {}
+        self.directory_changes = []
+
+    def load(self, size):
+        """Generate the valid files of a size, caching their digests. Stale entries are deleted."""
+        if size in self.loaded:
+            return
+        self.loaded.add(size)
+        stale = []
+        for row in self.connection.execute("SELECT device, inode, time_ns, change_time_ns, path, filenames, records, "
+                                           "sample, digest FROM inodes WHERE size = ?", (size,)).fetchall():
+            device, inode, time_ns, change_time_ns, path, filenames, records, sample, digest = row
+            path = os.fsdecode(path)
+            self.metrics.counters["stat_calls"] += 1
+            try:
+                status = os.lstat(path)
+            except OSError:
+                status = None
+            if status is None or (status.st_dev, signed(status.st_ino), status.st_size, status.st_mtime_ns,
+                                  status.st_ctime_ns) != (device, inode, size, time_ns, change_time_ns):
+                stale.append((device, inode))
+                continue
+            self.metrics.counters["stored_inodes"] += 1
+            file = File.__new__(File)
+            file.path = path
+            file.filenames = None
+            if filenames is not None:
+                file.filenames = [os.fsdecode(filename) for filename in filenames.split(b"\0")]
+                if len(file.filenames) > 8:
+                    file.filenames = {filename: position for position, filename in enumerate(file.filenames)}
+            file.values = array.array("q")
+            file.values.frombytes(records)
+            if sample is not None:
+                self.digests[(file.device, file.inode())] = [sample, digest]
+            yield file
+        if stale:
+            self.connection.executemany("DELETE FROM inodes WHERE device = ? AND inode = ?", stale)
+
+    def directory(self, path, options):
+        """Modification time, change time and subdirectories recorded for a directory scanned with the same options,
+        or None."""
+        row = self.connection.execute("SELECT time_ns, change_time_ns, subdirectories FROM directories "
+                                      "WHERE path = ? AND options = ?", (os.fsencode(path), options)).fetchone()
+        if row:
+            return row[0], row[1], [os.fsdecode(subdirectory) for subdirectory in row[2].split(b"\0") if subdirectory]
+
+    def write_directory(self, path, status, subdirectories, files, options):
+        """Record a scanned directory, with its status from before it was listed, a summary of its entries, and the
+        options that chose which of its files were processed."""
+        self.directory_changes.append((os.fsencode(path), status.st_mtime_ns, status.st_ctime_ns,
+                                       b"\0".join(os.fsencode(subdirectory) for subdirectory in subdirectories), files,
+                                       options))
+        if len(self.directory_changes) >= FLUSH_SIZE:
+            self.flush()
+
+    def write(self, file):
+        self.changes[(file.device, file.inode())] = file
+        if len(self.changes) >= FLUSH_SIZE:
+            self.flush()
+
+    def remove(self, file):
+        self.changes[(file.device, file.inode())] = None
+        if len(self.changes) >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Write changes through to the database file."""
+        rows = []
+        deleted = []
+        for (device, inode), file in self.changes.items():
+            if file is None:
+                deleted.append((device, signed(inode)))
+            else:
+                sample, digest = self.digests.get((device, inode), (None, None))
+                rows.append((device, signed(inode), file.size, file.time_ns, file.change_time_ns,
+                             os.fsencode(file.path), b"\0".join(os.fsencode(filename) for filename in file.filenames)
+                             if file.filenames else None, file.values.tobytes(), sample, digest))
+        with self.connection:
+            self.connection.executemany("DELETE FROM inodes WHERE device = ? AND inode = ?", deleted)
+            self.connection.executemany("INSERT OR REPLACE INTO inodes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.connection.executemany("INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?, ?)",
+                                        self.directory_changes)
+        self.changes.clear()
+        self.directory_changes.clear()
+
+    def close(self):
+        self.connection.close()
+
+
+class Attributes:
+    """Digest cache in an extended attribute of each inode, shared by all its links. Digests are trusted while the
+    inode's size and modification time are those they were computed at; the change time is not kept, as writing
+    the attribute changes it. Only the digests of files read in full are written, and none in a dry run."""
+
+    def __init__(self, metrics, writable=True):
+        self.metrics = metrics
+        self.writable = writable
+        # inodes looked up, files with digests to write, and devices without user extended attributes
+        self.read = set()
+        self.pending = {}
+        self.unsupported_devices = set()
+
+    def recall(self, file, digests):
+        """Cache the digests of an inode from its attribute, once, where still valid."""
+        key = (file.device, file.inode())
+        if key in self.read or file.device in self.unsupported_devices:
+            return
+        self.read.add(key)
+        try:
+            value = os.getxattr(file.path, DIGEST_ATTRIBUTE, follow_symlinks=False)
+        except OSError as error:
+            if error.errno in (errno.ENOTSUP, errno.EOPNOTSUPP):
+                self.unsupported_devices.add(file.device)
+            return
+        header = struct.calcsize(DIGEST_HEADER)
+        if len(value) != header + 2 * hashlib.blake2b().digest_size \
+                or struct.unpack_from(DIGEST_HEADER, value) != (file.size, file.time_ns):
+            self.metrics.counters["attribute_misses"] += 1
+            return
+        self.metrics.counters["attribute_hits"] += 1
+        digests[key] = [value[header:header + hashlib.blake2b().digest_size],
+                        value[header + hashlib.blake2b().digest_size:]]
+
+    def write(self, file, digests):
+        """Write an inode's digests to its attribute, where it still has the size and modification time they were
+        computed at, updating the file's change time. Returns True if written."""
+        if not self.writable or file.device in self.unsupported_devices or None in digests:
+            return False
+        try:
+            descriptor = os.open(file.path, os.O_RDONLY | os.O_NOFOLLOW)
+        except OSError:
+            return False
+        try:
+            self.metrics.counters["stat_calls"] += 2
+            status = os.fstat(descriptor)
+            if (status.st_ino, status.st_size, status.st_mtime_ns) != (file.inode(), file.size, file.time_ns):
+                return False
+            os.setxattr(descriptor, DIGEST_ATTRIBUTE, struct.pack(DIGEST_HEADER, file.size, file.time_ns)
+                        + digests[0] + digests[1])
+            file.change_time_ns = os.fstat(descriptor).st_ctime_ns
+        except OSError as error:
+            if error.errno in (errno.ENOTSUP, errno.EOPNOTSUPP):
+                self.unsupported_devices.add(file.device)
+            else:
+                self.metrics.counters["attribute_errors"] += 1
+            return False
+        finally:
+            os.close(descriptor)
+        self.metrics.counters["attribute_writes"] += 1
+        return True
+
+
+class Linker:
+    """Defines the link executor: replaces files with links through directory descriptors, journalling temporary names."""
+
+    def __init__(self, journal=None):
+        self.journal_filename = journal
+        self.journal = None
+        # open directory descriptors by path
+        self.descriptors = {}
+        # files with attributes to write, by device and inode
+        self.attributes = {}
+        self.links = 0
+        # temporary links that could not be removed, for recovery
+        self.stray = 0
+        # filenames renamed into place, recorded while their directories are watched
+        self.renamed = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *arguments):
+        self.close()
+
+    def recover(self):
+        """Remove temporary links left by an interrupted run."""
+        if self.journal_filename is None:
+            return
+        try:
+            with open(self.journal_filename, "rb") as journal:
+                names = journal.read().split(b"\0")[:-1]
+        except FileNotFoundError:
+            return
+        for name in names:
+            try:
+                os.unlink(name)
+            except FileNotFoundError:
+                pass
+            except OSError as error:
+                print("\nERROR: Failed to remove temporary link: %s" % error)
+            else:
+                print("Removed temporary link: %s" % strip_invalid_characters(os.fsdecode(name)))
+        os.unlink(self.journal_filename)
+
+    def locate(self, path):
+        """Directory descriptor and name to reach a path by."""
+        if os.link not in os.supports_dir_fd:
+            return None, path
+        directory, name = os.path.split(path)
+        # least recently used first
+        descriptor = self.descriptors.pop(directory, None)
+        if descriptor is None:
+            if len(self.descriptors) >= DIRECTORY_DESCRIPTORS:
+                os.close(self.descriptors.pop(next(iter(self.descriptors))))
+            descriptor = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        self.descriptors[directory] = descriptor
+        return descriptor, name
+
+    def link(self, source, filename):
+        """Link the source under a temporary name, then rename it over the filename, which is never missing.
+        Raises OSError where the link fails; returns False where the rename fails and the filename is unchanged."""
+        source_directory, source_name = self.locate(source)
+        directory, name = self.locate(filename)
+        temporary_name = name + TEMPORARY_SUFFIX
+        if self.journal_filename is not None:
+            if self.journal is None:
+                self.journal = open(self.journal_filename, "ab", buffering=0)
+            self.journal.write(os.fsencode(filename + TEMPORARY_SUFFIX) + b"\0")
+        os.link(source_name, temporary_name, src_dir_fd=source_directory, dst_dir_fd=directory)
+        try:
+            os.rename(temporary_name, name, src_dir_fd=directory, dst_dir_fd=directory)
+        except OSError as error:
+            print("\nERROR: Failed to rename: %s to %s: %s" % (filename + TEMPORARY_SUFFIX, filename, error))
+            self.remove(temporary_name, directory, filename)
+            return False
+        if self.renamed is not None:
+            self.renamed.add(os.path.normpath(filename))
+        # renaming over a link to the same inode succeeds without doing anything, leaving the temporary link
+        if not self.remove(temporary_name, directory, filename):
+            self.links += 1
+        return True
+
+    def remove(self, temporary_name, directory, filename):
+        """Remove a temporary link, leaving it in the journal where that fails. Returns whether it was there."""
+        try:
+            os.unlink(temporary_name, dir_fd=directory)
+        except FileNotFoundError:
+            return False
+        except OSError as error:
+            print("\nALERT: Failed to remove %s: %s" % (filename + TEMPORARY_SUFFIX, error))
+            self.stray += 1
+        return True
+
+    def update(self, file):
+        """Queue the file's attributes to write."""
+        self.attributes[(file.device, file.inode())] = file
+
+    def discard(self, file):
+        self.attributes.pop((file.device, file.inode()), None)
+
+    def flush(self):
+        """Write queued attributes once for each inode. Returns the files updated."""
+        files = list(self.attributes.values())
+        self.attributes.clear()
+        for file in files:
+            try:
+                os.chown(file.path, file.uid, file.gid)
+                os.utime(file.path, ns=(file.access_time_ns, file.time_ns))
+            except OSError as error:
+                print("\nERROR: Failed to update file attributes: %s" % error)
+        # no links are in progress, nor temporary links left
+        if self.journal is not None and not self.stray:
+            os.ftruncate(self.journal.fileno(), 0)
+        return files
+
+    def close(self):
+        self.flush()
+        for descriptor in self.descriptors.values():
+            os.close(descriptor)
+        self.descriptors.clear()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+            self.recover()
+
+
+class Events:
+    """Defines a stream of link events and already hardlinked files, as JSON lines or CSV, written as they happen."""
+
+    FIELDS = ("event", "inode", "size", "links", "path", "source", "saved", "reason")
+
+    def __init__(self, filename, format="jsonl"):
+        self.filename = filename
+        if filename == "-":
+            self.file = sys.stdout
+        else:
+            self.file = open(filename, "w", buffering=1, newline="", errors="surrogateescape")
+        self.writer = None
+        if format == "csv":
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(self.FIELDS)
+
+    def write(self, **record):
+        if self.writer is not None:
+            self.writer.writerow([record.get(field, "") for field in self.FIELDS])
+        else:
+            self.file.write(json.dumps(record) + "\n")
+
+    def link(self, source, destination, filename, dry_run=False):
+        """A filename linked, or to be linked in a dry run, to the source inode."""
+        self.write(event="planned" if dry_run else "linked", inode=source.inode(), size=source.size,
+                   links=source.links, path=filename, source=source.path,
+                   saved=destination.size if destination.total_links(filename) == 1 else 0)
+
+    def existing(self, file):
+        """A file found already hardlinked."""
+        self.write(event="existing", inode=file.inode(), size=file.size, links=file.links, path=file.path)
+
+    def skipped(self, file, known_file, reason):
+        """A file matching a known file, left unlinked."""
+        self.write(event="skipped", inode=file.inode(), size=file.size, links=file.links, path=file.path,
+                   source=known_file.path, reason=reason)
+
+    def error(self, path, error):
+        """A file or directory that could not be read or linked."""
+        self.write(event="error", path=path, reason=str(error))
+
+    def close(self):
+        # standard output is only borrowed, and may be redirected by now
+        if self.filename == "-":
+            self.file.flush()
+        else:
+            self.file.close()
+
+
+class EventQueue(Events):
+    """Defines a stream of events handed as dicts to a consumer in another thread, bounded so the scan waits on it."""
+
+    def __init__(self):
+        self.queue = queue.Queue(BATCH_SIZE)
+
+    def write(self, **record):
+        self.queue.put(record)
+
+    def close(self):
+        self.queue.put(None)
+
+
+class Plan:
+    """Defines a link plan file: JSON lines of a source inode and the destination filenames to link to it."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.entries = 0
+
+    def write(self, source, destination):
+        """Record linking the destination filenames to the source, with the state each is expected to be in."""
+        if self.file is None:
+            self.file = open(self.filename, "w")
+        attributes = None
+        if destination.time_ns > source.time_ns:
+            attributes = [destination.uid, destination.gid, destination.access_time_ns, destination.time_ns]
+        # later entries expect the state left by earlier ones, as in a dry run
+        self.file.write(json.dumps({"source": source.path, "device": source.device, "inode": source.inode(),
+                                    "size": source.size, "time_ns": source.time_ns,
+                                    "destinations": [[filename, destination.inode(), destination.time_ns]
+                                                     for filename in destination.files],
+                                    "attributes": attributes}) + "\n")
+        self.entries += 1
+
+    def close(self):
+        if self.file is None:
+            # an empty plan
+            self.file = open(self.filename, "w")
+        self.file.close()
+
+    def apply(self, linker, verbose=0):
+        """Link each planned destination still as recorded. Returns counts of links made and skipped."""
+        linked = skipped = 0
+        with open(self.filename) as plan:
+            for line in plan:
+                entry = json.loads(line)
+                source = entry["source"]
+                if not self.unchanged(source, entry["device"], entry["inode"], entry["size"], entry["time_ns"]):
+                    print("\nSkipped: %s changed since planned" % strip_invalid_characters(source))
+                    skipped += len(entry["destinations"])
+                    continue
+                links = 0
+                for filename, inode, time_ns in entry["destinations"]:
+                    if not self.unchanged(filename, entry["device"], inode, entry["size"], time_ns):
+                        print("\nSkipped: %s changed since planned" % strip_invalid_characters(filename))
+                        skipped += 1
+                        continue
+                    try:
+                        replaced = linker.link(source, filename)
+                    except OSError as error:
+                        print("\nERROR: Failed to hardlink: %s to %s: %s" % (
+                            strip_invalid_characters(source), strip_invalid_characters(filename), error))
+                        replaced = False
+                    if replaced:
+                        links += 1
+                        if verbose >= 1:
+                            print("\n Linked: %s" % strip_invalid_characters(source))
+                            print("     to: %s" % strip_invalid_characters(filename))
+                    else:
+                        skipped += 1
+                # update to latest attributes, once for the inode
+                if links and entry["attributes"]:
+                    uid, gid, access_time_ns, time_ns = entry["attributes"]
+                    try:
+                        os.chown(source, uid, gid)
+                        os.utime(source, ns=(access_time_ns, time_ns))
+                    except OSError as error:
+                        print("\nERROR: Failed to update file attributes: %s" % error)
+                linked += links
+                linker.flush()
+        return linked, skipped
+
+    def unchanged(self, path, device, inode, size, time_ns):
+        try:
+            status = os.lstat(path)
+        except OSError:
+            return False
+        return (status.st_dev, status.st_ino, status.st_size, status.st_mtime_ns) == (device, inode, size, time_ns)
+
+
+class Spill:
+    """Defines the out-of-core file list: records of size, inode and path for each device, sorted in runs spilled to
+    temporary files, and merged back in order of size, one device at a time."""
+
+    RECORD = struct.Struct("<QQI")
+
+    def __init__(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="hardlink-")
+        # records and run files by device
+        self.records = {}
+        self.runs = {}
+        self.count = 0
+        # incremental directory records, held until the files listed are processed
+        self.directory_records = None
+
+    def add(self, file):
+        self.records.setdefault(file.device, []).append((file.size, file.inode(), os.fsencode(file.path)))
+        self.count += 1
+        if self.count >= SPILL_RECORDS:
+            self.write_run()
+
+    def write_run(self):
+        for device, records in self.records.items():
+            records.sort()
+            runs = self.runs.setdefault(device, [])
+            filename = os.path.join(self.directory.name, "%i.%i" % (device, len(runs)))
+            with open(filename, "wb") as run:
+                for size, inode, path in records:
+                    run.write(self.RECORD.pack(size, inode, len(path)) + path)
+            runs.append(filename)
+        self.records = {}
+        self.count = 0
+
+    def read_run(self, filename):
+        with open(filename, "rb") as run:
+            for header in iter(lambda: run.read(self.RECORD.size), b""):
+                size, inode, length = self.RECORD.unpack(header)
+                yield size, inode, run.read(length)
+
+    def devices(self):
+        return sorted(set(self.records) | set(self.runs))
+
+    def sizes(self, device=None):
+        """Generate each file size with its paths, links to an inode together, in order of size, for one device or
+        each device in turn."""
+        for device in self.devices() if device is None else (device,):
+            records = self.records.get(device, [])
+            records.sort()
+            for size, records in itertools.groupby(heapq.merge(records, *map(self.read_run, self.runs.get(device, []))),
+                                                   key=lambda record: record[0]):
+                yield size, [os.fsdecode(record[2]) for record in records]
+
+    def shards(self, files):
+        """Generate ranges of whole file sizes on one device, with their paths, of at least the given number of
+        files, taking the devices in turn so that each filesystem is processed alongside the others."""
+        ranges = [self.ranges(device, files) for device in self.devices()]
+        for shard in itertools.chain.from_iterable(itertools.zip_longest(*ranges)):
+            if shard is not None:
+                yield shard
+
+    def ranges(self, device, files):
+        shard = []
+        count = 0
+        for size, paths in self.sizes(device):
+            shard.append((size, paths))
+            count += len(paths)
+            if count >= files:
+                yield shard
+                shard = []
+                count = 0
+        if shard:
+            yield shard
+
+    def add_directory(self, record):
+        if self.directory_records is None:
+            self.directory_records = open(os.path.join(self.directory.name, "directories"), "w+b")
+        pickle.dump(record, self.directory_records, pickle.HIGHEST_PROTOCOL)
+
+    def directories(self):
+        """Generate the directory records, in the order added."""
+        if self.directory_records is None:
+            return
+        self.directory_records.seek(0)
+        while True:
+            try:
+                yield pickle.load(self.directory_records)
+            except EOFError:
+                return
+
+    def close(self):
+        if self.directory_records is not None:
+            self.directory_records.close()
+        self.directory.cleanup()
+
+
+class Checkpoint:
+    """Defines the checkpoint file of a scan: the directories still to scan, with the database, statistics and
+    metrics, pickled and written atomically at an interval, and removed once the scan completes."""
+
+    def __init__(self, filename, interval=CHECKPOINT_INTERVAL):
+        self.filename = filename
+        self.interval = interval
+        self.last = time.monotonic()
+
+    def due(self):
+        return time.monotonic() - self.last >= self.interval
+
+    def save(self, search, directories, dry_run=False):
+        """Write the state of a search between directories, with the directories still to scan."""
+        self.last = time.monotonic()
+        state = {"signature": search.signature(dry_run), "directories": directories, "database": search.database,
+                 "links": search.linker.links, "elapsed": time.time() - search.database.start_time}
+        if search.database.store:
+            search.database.store.flush()
+        with search.metrics.timer("checkpoint"):
+            temporary = self.filename + ".tmp"
+            with open(temporary, "wb") as file:
+                pickle.dump(state, file, pickle.HIGHEST_PROTOCOL)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, self.filename)
+        search.metrics.counters["checkpoints"] += 1
+
+    def load(self):
+        with open(self.filename, "rb") as file:
+            return pickle.load(file)
+
+    def remove(self):
+        try:
+            os.unlink(self.filename)
+        except FileNotFoundError:
+            pass
+
+
+class Watcher:
+    """Defines a watch on directories through Linux inotify, for files written or moved into them."""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.descriptor = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.descriptor < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        # watched directories by watch descriptor
+        self.directories = {}
+
+    def add(self, directory):
+        """Watch a directory, unless as many are watched as allowed. Returns False if it is not watched."""
+        if len(self.directories) >= WATCH_DIRECTORIES:
+            return False
+        watch = self.libc.inotify_add_watch(self.descriptor, os.fsencode(directory), WATCH_MASK)
+        if watch < 0:
+            if ctypes.get_errno() == errno.ENOSPC:
+                # the kernel's limit of watches
+                return False
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), directory)
+        self.directories[watch] = directory
+        return True
+
+    def remove(self, watch):
+        self.libc.inotify_rm_watch(self.descriptor, watch)
+        self.directories.pop(watch, None)
+
+    def read(self, timeout=None):
+        """Events waiting, or arriving within the timeout, as (watch, directory, name, mask)."""
+        if not select.select([self.descriptor], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.descriptor, WATCH_BUFFER)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            watch, mask, _, length = struct.unpack_from("iIII", data, offset)
+            name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b"\0"))
+            offset += 16 + length
+            if mask & IN_IGNORED:
+                # removed, or its directory deleted
+                self.directories.pop(watch, None)
+            else:
+                events.append((watch, self.directories.get(watch), name, mask))
+        return events
+
+    def close(self):
+        os.close(self.descriptor)
 
 
 class Search:
     """Defines the hardlink search-space."""
 
     def __init__(self, directories, matching, excluding, minimum_size, maximum_size, check_name, check_timestamp,
-                 check_properties):
-        self.maximum_links = os.pathconf(directories[0], "PC_LINK_MAX")
+                 check_properties, jobs=1, depth_first=False, incremental=False, plan=None,
+                 linker=None, events=None, ignoring=(), out_of_core=False, physical_order=False, database=None,
+                 watcher=None, processes=1, checkpoint=None):
+        # PC_LINK_MAX of each device
+        self.link_limits = {}
         self.directories = directories
+        self.roots = list(directories)
         self.matching = matching
         self.excluding = excluding
+        # exclusions merged, and the match and ignore file patterns translated, once
+        self.exclusions = compile_patterns(excluding)
+        self.match = re.compile(fnmatch.translate(matching)).match if matching else None
+        self.ignoring = ignoring
+        self.ignored_files = compile_patterns([fnmatch.translate(pattern) for pattern in ignoring
+                                               if not pattern.endswith("/")])
+        self.ignored_directories = compile_patterns([fnmatch.translate(pattern.rstrip("/")) for pattern in ignoring])
         self.minimum_size = minimum_size
         self.maximum_size = maximum_size
         self.check_name = check_name
         self.check_timestamp = check_timestamp
         self.check_properties = check_properties
-        self.database = Database()
+        self.jobs = jobs
+        # worker processes, each linking a range of file sizes
+        self.processes = processes
+        self.depth_first = depth_first
+        self.incremental = incremental
+        self.out_of_core = out_of_core
+        self.physical_order = physical_order
+        # physical location of the files read for the batch, and devices where FIEMAP is not supported
+        self.locations = {}
+        self.unmapped_devices = set()
+        # link generation of the oldest files in the batch, held across directories in physical order
+        self.pending = None
+        # link plan recorded instead of linking
+        self.plan = plan
+        self.linker = linker or Linker()
+        # stream of link events
+        self.events = events
+        # inotify watch on the directories scanned, in watch mode, and whether the scan is done and watching
+        self.watcher = watcher
+        self.watching = False
+        # periodic checkpoint of the scan, and the directories being listed ahead
+        self.checkpoint = checkpoint
+        self.listings = collections.deque()
+        # paths of files changed since the checkpoint resumed from, to process again first
+        self.stale = []
+        # status of directories being scanned in incremental mode, read before listing
+        self.statuses = {}
+        self.pool = None
+        # byte-for-byte comparisons confirmed ahead by the workers
+        self.verified = {}
+        # link generation, and the generation each cluster of inodes was last linked at, by its root
+        self.generation = 0
+        self.touched = {}
+        self.clusters = Clusters()
+        # set from another thread to end the scan early
+        self.stopped = False
+        self.database = database if database is not None else Database()
+        self.metrics = self.database.metrics
+        if watcher is not None or checkpoint is not None:
+            self.database.retained = True
+        if watcher is not None:
+            self.linker.renamed = set()
 
     def scan(self, verbose=0, dry_run=False, no_confirm=False):
         """Recursively scan directories checking for hardlinkable files."""
-        while self.directories:
-            directory = self.directories.pop() + "/"
-            assert os.path.isdir(directory)
+        self.no_confirm = no_confirm
+        if self.jobs > 1:
+            self.pool = concurrent.futures.ThreadPoolExecutor(self.jobs)
+        start = time.perf_counter()
+        processing = self.metrics.timers["processing"]
+        # file records held on disk until traversal is complete, in out-of-core and sharded modes
+        spill = Spill() if self.out_of_core or self.processes > 1 else None
+        # directories recorded in incremental mode once their files are processed
+        directories = []
+        batch = []
+        debugging = logging.getLogger().isEnabledFor(logging.DEBUG)
+        try:
+            if self.stale:
+                paths, self.stale = self.stale, []
+                if not self.process_paths(paths, verbose, dry_run):
+                    return False
+            for directory, directory_entries, generation in self.walk():
+                self.metrics.counters["directories"] += 1
+                if not batch:
+                    self.pending = generation
+                subdirectories = []
+                files = 0
+                for directory_entry in directory_entries:
+                    self.metrics.counters["entries"] += 1
+                    # exclude symbolic link
+                    if directory_entry.is_symlink():
+                        continue
+                    is_directory = directory_entry.is_dir()
+                    if is_directory:
+                        subdirectories.append(directory_entry.path)
+                    else:
+                        files += 1
+                    # user exclusions, pruning excluded directories, before any stat
+                    if self.excluded(directory_entry.path, directory_entry.name, is_directory):
+                        continue
+                    # add new directory
+                    if is_directory:
+                        self.directories.append(directory_entry.path)
+                    # matching requirements
+                    elif self.match is None or self.match(directory_entry.name):
+                        self.metrics.counters["stat_calls"] += 1
+                        new_file = File(directory_entry.path, directory_entry.stat(follow_symlinks=False))
+                        if debugging:
+                            logging.debug("PROCESSING %s %i %i", strip_invalid_characters(new_file.path),
+                                          new_file.inode(), new_file.links)
+                        if self.candidate(new_file):
+                            if spill is not None:
+                                spill.add(new_file)
+                                continue
+                            batch.append(new_file)
+                            if len(batch) >= BATCH_SIZE:
+                                if not self.process(batch, self.pending, verbose, dry_run):
+                                    return False
+                                batch = []
+                                self.pending = generation
+                # in physical order, files are held for a full batch across directories
+                if not self.physical_order:
+                    if not self.process(batch, self.pending, verbose, dry_run):
+                        return False
+                    batch = []
+                # not where links were only planned
+                if self.incremental and not dry_run:
+                    record = (directory, self.statuses.pop(directory), subdirectories, files, self.options())
+                    if spill is not None:
+                        spill.add_directory(record)
+                    else:
+                        directories.append(record)
+                        if not batch:
+                            for record in directories:
+                                self.database.store.write_directory(*record)
+                            directories = []
+                elif self.incremental:
+                    del self.statuses[directory]
+                # with every file listed so far processed
+                if self.checkpoint is not None and not batch and spill is None and self.checkpoint.due():
+                    self.checkpoint.save(self, self.directories + [directory[:-1] for directory, _, _ in self.listings],
+                                         dry_run)
+            if not self.process(batch, self.pending, verbose, dry_run):
+                return False
+            for record in directories:
+                self.database.store.write_directory(*record)
+            if spill is not None:
+                if not (self.process_sharded(spill, verbose, dry_run) if self.processes > 1
+                        else self.process_sizes(spill.sizes(), verbose, dry_run)):
+                    return False
+                for record in spill.directories():
+                    self.database.store.write_directory(*record)
+        finally:
+            if spill is not None:
+                spill.close()
+            if self.pool:
+                self.pool.shutdown()
+                self.pool = None
+            # listing and status, outside processing
+            self.metrics.timers["traversal"] += time.perf_counter() - start \
+                - (self.metrics.timers["processing"] - processing)
+            self.metrics.counters["links_created"] = self.linker.links
+        return True
+
+    def signature(self, dry_run=False):
+        """Options a checkpoint must have been written with to resume from it."""
+        return (self.roots, self.matching, self.excluding, list(self.ignoring), self.minimum_size, self.maximum_size,
+                self.check_name, self.check_timestamp, self.check_properties, dry_run)
+
+    def options(self):
+        """Options deciding which files of a directory are processed, that an incremental record must have been
+        written with to skip the directory."""
+        return json.dumps((self.matching, self.excluding, list(self.ignoring), self.minimum_size, self.maximum_size,
+                           self.check_name, self.check_timestamp, self.check_properties))
+
+    def resume(self, dry_run=False):
+        """Continue from the checkpoint, with its database, less the files changed on disk since, and the
+        directories it had still to scan. Raises ValueError where it was written by a scan with other options."""
+        state = self.checkpoint.load()
+        if state["signature"] != self.signature(dry_run):
+            raise ValueError("%s was written by a scan with other directories or options" % self.checkpoint.filename)
+        self.directories[:] = state["directories"]
+        self.database = state["database"]
+        self.database.start_time = time.time() - state["elapsed"]
+        self.metrics = self.database.metrics
+        self.linker.links = state["links"]
+        # files linked or changed since the checkpoint was written are dropped and processed again
+        for fingerprint in list(self.database.fingerprints):
+            for file in self.database.validate(fingerprint):
+                self.stale.extend(file.files)
+
+    def candidate(self, new_file):
+        """Whether a file is to be processed: within size limits, no zero size, under maximum links."""
+        if (new_file.size >= self.minimum_size) \
+                and ((new_file.size <= self.maximum_size) or (self.maximum_size == 0)) \
+                and (new_file.links < self.maximum_links(new_file)) and new_file.size > 0:
+            if self.events is not None and new_file.links > 1:
+                self.events.existing(new_file)
+            self.metrics.counters["files"] += 1
+            return True
+        return False
+
+    def walk(self):
+        """Generate the entries of each directory, listing directories ahead across the workers unless depth-first.
+        Each listing comes with the link generation it was read at."""
+        if self.pool is None or self.depth_first:
+            while self.directories:
+                directory = self.directories.pop() + "/"
+                self.watch_directory(directory)
+                if self.unchanged(directory):
+                    continue
+                assert os.path.isdir(directory)
+                try:
+                    directory_entries = os.scandir(directory)
+                except OSError as error:
+                    self.report(directory, error)
+                    continue
+                yield directory, directory_entries, self.generation
+                self.touched.clear()
+        else:
+            # bounded number of directories listed ahead, consumed in the order submitted
+            listings = self.listings
+            while self.directories or listings:
+                while self.directories and len(listings) < 2 * self.jobs:
+                    directory = self.directories.pop() + "/"
+                    self.watch_directory(directory)
+                    if not self.unchanged(directory):
+                        listings.append((directory, self.pool.submit(list_directory, directory), self.generation))
+                if not listings:
+                    continue
+                directory, listing, generation = listings.popleft()
+                # links older than the oldest listing, or than the files held, no longer matter
+                if len(self.touched) > BATCH_SIZE:
+                    oldest = generation if self.pending is None else min(generation, self.pending)
+                    self.touched = {inode: linked for inode, linked in self.touched.items() if linked > oldest}
+                try:
+                    directory_entries = listing.result()
+                except OSError as error:
+                    self.report(directory, error)
+                    continue
+                yield directory, directory_entries, generation
+
+    def watch_directory(self, directory):
+        """In watch mode, watch a directory before it is listed, so no file landing after is missed."""
+        if self.watcher is None:
+            return
+        try:
+            if not self.watcher.add(directory):
+                self.metrics.counters["directories_unwatched"] += 1
+                if self.metrics.counters["directories_unwatched"] == 1:
+                    print("\nERROR: Watch limit reached, not watching %s or further new directories"
+                          % strip_invalid_characters(directory))
+        except OSError as error:
+            self.report(directory, error)
+
+    def watch(self, verbose=0, dry_run=False):
+        """Hardlink files as they are written or moved into the watched directories, until interrupted or stopped.
+        Events are coalesced for a while after the first, or until a batch of files is pending; new directories
+        are scanned."""
+        self.watching = True
+        # pending files and directories, by path, so repeated events are handled once
+        files = {}
+        directories = {}
+        deadline = None
+        try:
+            while not self.stopped:
+                events = self.watcher.read(WATCH_DELAY if deadline is None
+                                           else max(0, deadline - time.monotonic()))
+                if not events:
+                    # the events of every link made so far have been read
+                    self.linker.renamed.clear()
+                for watch, directory, name, mask in events:
+                    if mask & IN_Q_OVERFLOW:
+                        # events lost, rescan
+                        self.metrics.counters["watch_overflows"] += 1
+                        directories.update(dict.fromkeys(self.roots))
+                    elif directory is None:
+                        continue
+                    elif mask & IN_MOVE_SELF:
+                        # watched again where it was moved to, if that is in the tree
+                        self.watcher.remove(watch)
+                    elif mask & IN_ISDIR:
+                        path = os.path.join(directory, name)
+                        if not self.excluded(path, name, True):
+                            directories[path] = None
+                    elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                        # created files only once closed, as linking one still open for writing loses what follows
+                        path = os.path.join(directory, name)
+                        # not links renamed into place by the linker
+                        if mask & IN_MOVED_TO and os.path.normpath(path) in self.linker.renamed:
+                            self.linker.renamed.discard(os.path.normpath(path))
+                        else:
+                            files[path] = None
+                if deadline is None and (files or directories):
+                    deadline = time.monotonic() + WATCH_DELAY
+                if deadline is None or time.monotonic() < deadline and len(files) < BATCH_SIZE:
+                    continue
+                deadline = None
+                if directories:
+                    self.directories.extend(directories)
+                    directories.clear()
+                    if not self.scan(verbose, dry_run, self.no_confirm):
+                        return False
+                if files:
+                    self.metrics.counters["watch_batches"] += 1
+                    if not self.process_paths(list(files), verbose, dry_run):
+                        return False
+                    files.clear()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.watcher.close()
+        return True
+
+    def process_paths(self, paths, verbose=0, dry_run=False):
+        """Hardlink files by path."""
+        generation = self.generation
+        batch = []
+        for path in paths:
+            name = os.path.basename(path)
+            if self.excluded(path, name) or self.match is not None and not self.match(name):
+                continue
+            self.metrics.counters["stat_calls"] += 1
             try:
-                directory_entries = os.scandir(directory)
+                status = os.lstat(path)
+            except FileNotFoundError:
+                continue
             except OSError as error:
-                print(directory, error)
+                self.report(path, error)
                 continue
-            inodes_hardlinked = []
-            for directory_entry in directory_entries:
-                # exclude symbolic link
-                if directory_entry.is_symlink():
-                    continue
-                # user exclusions
-                exclude = False
-                for pattern in self.excluding:
-                    if re.search(pattern, directory_entry.path):
-                        exclude = True
-                        break
-                if exclude:
-                    continue
-                # add new directory
-                if directory_entry.is_dir():
-                    self.directories.append(directory_entry.path)
+            if not stat.S_ISREG(status.st_mode):
+                continue
+            new_file = File(path, status)
+            if self.candidate(new_file):
+                batch.append(new_file)
+        return self.process(batch, generation, verbose, dry_run)
+
+    def excluded(self, path, name=None, directory=False):
+        """User exclusions by path, and ignore file patterns by name."""
+        for pattern in self.exclusions:
+            if pattern.search(path):
+                return True
+        if self.ignoring:
+            if name is None:
+                name = os.path.basename(path.rstrip("/"))
+            for pattern in self.ignored_directories if directory else self.ignored_files:
+                if pattern.match(name):
+                    return True
+        return False
+
+    def unchanged(self, directory):
+        """In incremental mode, descend without listing into a directory unchanged since it was last recorded."""
+        if not self.incremental:
+            return False
+        self.metrics.counters["stat_calls"] += 1
+        try:
+            status = os.lstat(directory)
+        except OSError as error:
+            self.report(directory, error)
+            return True
+        record = self.database.store.directory(directory, self.options())
+        if record and record[:2] == (status.st_mtime_ns, status.st_ctime_ns):
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("UNCHANGED %s", strip_invalid_characters(directory))
+            self.metrics.counters["directories_unchanged"] += 1
+            for subdirectory in record[2]:
+                if not self.excluded(subdirectory, directory=True):
+                    self.directories.append(subdirectory)
+            return True
+        self.statuses[directory] = status
+        return False
+
+    def process(self, batch, generation=None, verbose=0, dry_run=False):
+        """Hardlink a batch of new files in order, hashing them ahead in parallel when there are workers."""
+        start = time.perf_counter()
+        for new_file in batch:
+            self.database.load_size(new_file.size, self.fingerprint)
+        if self.watching:
+            batch = batch + self.revalidate(batch)
+        with self.metrics.timer("comparison"):
+            self.prefetch(batch)
+        try:
+            for new_file in batch:
+                if self.stopped:
+                    return False
+                # inodes linked since the batch was read need a fresh status
+                if generation is not None \
+                        and self.touched.get(self.clusters.find((new_file.device, new_file.inode())), 0) > generation:
+                    self.update_attributes()
+                    self.metrics.counters["stat_calls"] += 1
+                    try:
+                        new_file = File(new_file.path, os.lstat(new_file.path))
+                    except OSError as error:
+                        self.report(new_file.path, error)
+                        continue
+                if not self.process_file(new_file, verbose, dry_run):
+                    return False
+        finally:
+            self.verified.clear()
+            self.locations.clear()
+            self.database.runs.clear()
+            self.update_attributes()
+            self.write_digests()
+            self.metrics.timers["processing"] += time.perf_counter() - start
+        return True
+
+    def process_sizes(self, sizes, verbose=0, dry_run=False, release=True):
+        """Hardlink files one size at a time, by path, releasing each size from memory once it is processed."""
+        for size, paths in sizes:
+            for first in range(0, len(paths), BATCH_SIZE):
+                generation = self.generation
+                batch = []
+                for path in paths[first:first + BATCH_SIZE]:
+                    self.metrics.counters["stat_calls"] += 1
+                    try:
+                        batch.append(File(path, os.lstat(path)))
+                    except OSError as error:
+                        self.report(path, error)
+                if not self.process(batch, generation, verbose, dry_run):
+                    return False
+            if release:
+                self.database.release()
+                self.touched.clear()
+                self.clusters.clear()
+        return True
+
+    def process_sharded(self, spill, verbose=0, dry_run=False):
+        """Hand ranges of file sizes on each device to worker processes, each hardlinking its own with a database of
+        its own, and merge their databases. An inode has one device and size, so no two workers link the same inode,
+        and the filesystems are processed concurrently."""
+        start = time.perf_counter()
+        processing = self.metrics.timers["processing"]
+        options = (self.check_name, self.check_timestamp, self.check_properties, self.jobs, self.physical_order,
+                   None if self.database.attributes is None else self.database.attributes.writable)
+        # files kept for the reports, unless out-of-core
+        release = self.out_of_core
+        pool = concurrent.futures.ProcessPoolExecutor(self.processes)
+        futures = set()
+        try:
+            for index, shard in enumerate(spill.shards(SHARD_FILES)):
+                if self.stopped:
+                    return False
+                journal = None if self.linker.journal_filename is None \
+                    else "%s.%i" % (self.linker.journal_filename, index)
+                futures.add(pool.submit(process_shard, options, shard, journal, verbose, dry_run, release))
+                # bounded shards in hand
+                if len(futures) >= 2 * self.processes \
+                        and not self.merge_shards(futures, concurrent.futures.FIRST_COMPLETED):
+                    return False
+            return self.merge_shards(futures, concurrent.futures.ALL_COMPLETED)
+        finally:
+            pool.shutdown(cancel_futures=True)
+            # wall time, the workers' own timers being summed into the metrics
+            self.metrics.timers["processing"] = processing + time.perf_counter() - start
+
+    def merge_shards(self, futures, return_when):
+        """Merge the databases of finished shards. Returns False if a shard was stopped."""
+        done, pending = concurrent.futures.wait(futures, return_when=return_when)
+        completed = True
+        for future in done:
+            database, links, shard_completed = future.result()
+            self.database.merge(database)
+            self.linker.links += links
+            completed = completed and shard_completed
+        futures.intersection_update(pending)
+        return completed
+
+    def report(self, path, error, message=None):
+        """Print an error on a file or directory, streaming it as an event."""
+        print(message or "%s %s" % (path, error))
+        if self.events is not None:
+            self.events.error(path, error)
+
+    def revalidate(self, batch):
+        """Once watching, drop the known files of the batch's fingerprints changed since they were recorded, and the
+        digests of new inodes, as the inode numbers freed by linking are reused. Returns the files dropped that
+        are still there, with a fresh status, to be processed again."""
+        stale = []
+        for fingerprint in {self.fingerprint(new_file) for new_file in batch}:
+            stale += self.database.validate(fingerprint)
+        paths = {new_file.path for new_file in batch}
+        files = []
+        for file in stale:
+            if file.path in paths:
+                continue
+            self.metrics.counters["stat_calls"] += 1
+            try:
+                status = os.lstat(file.path)
+            except OSError:
+                continue
+            if stat.S_ISREG(status.st_mode):
+                new_file = File(file.path, status)
+                if self.candidate(new_file):
+                    files.append(new_file)
+        for new_file in batch + files:
+            self.database.load_size(new_file.size, self.fingerprint)
+            if (new_file.device, new_file.inode()) not in self.database.bucket(self.fingerprint(new_file)):
+                self.database.forget(new_file)
+        return files
+
+    def update_attributes(self):
+        """Write the attributes queued while linking, keeping the persistent database valid."""
+        with self.metrics.timer("linking"):
+            files = self.linker.flush()
+        for file in files:
+            if self.database.store or self.database.retained:
+                self.metrics.counters["stat_calls"] += 1
+                try:
+                    file.change_time_ns = os.lstat(file.path).st_ctime_ns
+                except OSError as error:
+                    self.report(file.path, error)
+                self.database.update(file, self.fingerprint(file))
+            # a new modification time invalidates the digest attribute
+            if self.database.attributes and self.database.cached_digests(file)[1] is not None:
+                self.database.attributes.pending[(file.device, file.inode())] = file
+
+    def write_digests(self):
+        """Write the full digests read this batch to the attributes of the inodes still in the database, keeping the
+        persistent database valid and refreshing the status of their links not yet processed."""
+        attributes = self.database.attributes
+        if not attributes or not attributes.pending:
+            return
+        self.generation += 1
+        for key, file in attributes.pending.items():
+            fingerprint = self.fingerprint(file)
+            # the record of the inode, unless linked over or not added
+            file = self.database.bucket(fingerprint).get(key)
+            if file is None:
+                continue
+            if attributes.write(file, self.database.cached_digests(file)):
+                self.touched[self.clusters.find(key)] = self.generation
+                if self.database.store or self.database.retained:
+                    self.database.update(file, fingerprint)
+        attributes.pending.clear()
+
+    def process_file(self, new_file, verbose=0, dry_run=False):
+        """Add a new file to the database, hardlinking it to a known identical inode."""
+        # create file index
+        fingerprint = self.fingerprint(new_file)
+        if verbose >= 3:
+            print("File: %s" % new_file.path)
+        self.database.tally.found(new_file)
+        if fingerprint in self.database.fingerprints:
+            # already hardlinked
+            if (new_file.device, new_file.inode()) in self.database.bucket(fingerprint):
+                known_file = self.database.lookup(fingerprint, (new_file.device, new_file.inode()))
+                if known_file.new_filename(new_file.path, new_file.inode(), new_file.links, 0):
+                    self.database.tally.files += 1
+                if not dry_run:
+                    known_file.links = new_file.links
+                known_file.change_time_ns = new_file.change_time_ns
+                self.database.update(known_file, fingerprint)
+                return True
+            # check if hardlinkable: samename, properties, owner, group, time, then contents
+            constraints = self.constraints(new_file)
+            self.indexed(fingerprint)
+            try:
+                with self.metrics.timer("comparison"):
+                    known_file = self.database.match(new_file, fingerprint, constraints)
+            except OSError as error:
+                known_file = None
+                self.report(new_file.path, error, "\nERROR: Failed to compare files: %s" % error)
+            # maximum links
+            if known_file is not None and known_file.inode() != new_file.inode() \
+                    and known_file.links < self.maximum_links(known_file):
+                # confirm equal contents
+                if verbose > 1:
+                    print("Comparing: %s" % new_file.path)
+                    print("       to: %s" % known_file.path)
+                # check if we need to compare files or the inodes are already seen this run
+                if self.already_compared(new_file, known_file):
+                    logging.debug("ALREADY COMPARED")
+                    compared = True
+                elif self.database.compared_in_lockstep(new_file, known_file):
+                    logging.debug("COMPARED IN LOCKSTEP")
+                    compared = True
+                elif ((new_file.device, new_file.inode()), (known_file.device, known_file.inode())) in self.verified:
+                    compared = self.verified[((new_file.device, new_file.inode()),
+                                              (known_file.device, known_file.inode()))]
                 else:
-                    new_file = File(directory_entry)
-                    logging.debug("PROCESSING " + strip_invalid_characters(new_file.path) + " " + str(
-                        new_file.inode()) + " " + str(new_file.links))
-                    # is a file within size limits, no zero size, under maximum links
-                    if (new_file.size >= self.minimum_size) \
-                            and ((new_file.size <= self.maximum_size) or (self.maximum_size == 0)) \
-                            and (new_file.links < self.maximum_links) and new_file.size > 0:
-                        # matching requirements
-                        if self.matching:
-                            if not fnmatch.fnmatch(new_file.name, self.matching):
-                                continue
-                        # create file index
-                        if self.check_timestamp or self.check_properties:
-                            fingerprint = (new_file.size, new_file.time)
+                    self.metrics.counters["byte_comparisons"] += 1
+                    try:
+                        with self.metrics.timer("comparison"):
+                            compared, read = compare_files(new_file.path, known_file.path)
+                        self.metrics.counters["bytes_read"] += read
+                    except Exception as error:
+                        compared = False
+                        self.report(new_file.path, error, "\nERROR: Failed to compare files: %s" % error)
+                if compared:
+                    # hardlink files
+                    if not self.no_confirm:
+                        answer = input(
+                            "\nHardlinking:\n\n    " + known_file.path + "\n to " + new_file.path + "\n\nConfirm? [yes/No/all] ").lower()
+                        if answer[0] == "y" or answer[0] == "a":
+                            ok = True
+                            if answer[0] == "a":
+                                self.no_confirm = True
                         else:
-                            fingerprint = new_file.size
-                        if verbose >= 3:
-                            print("File: %s" % new_file.path)
-                        if fingerprint in self.database.fingerprints:
-                            # check for hardlink in dictionary
-                            for inode in self.database.fingerprints[fingerprint]:
-                                known_file = self.database.lookup(fingerprint, inode)
-                                # already hardlinked
-                                if (new_file.device, new_file.inode()) == inode:
-                                    known_file.new_filename(new_file.path, new_file.inode(), new_file.links, 0)
-                                    if not dry_run:
-                                        known_file.links = new_file.links
-                                    self.database.update(known_file, fingerprint)
-                                    break
-                            else:
-                                # check if hardlinkable: samename, maximum links, properties, owner, group, time
-                                for inode in self.database.fingerprints[fingerprint]:
-                                    known_file = self.database.lookup(fingerprint, inode)
-                                    if known_file.inode() != new_file.inode() \
-                                            and (new_file.name == known_file.name or not self.check_name) \
-                                            and known_file.links < self.maximum_links \
-                                            and (new_file.mode == known_file.mode or not self.check_properties) \
-                                            and (new_file.uid == known_file.uid or not self.check_properties) \
-                                            and (new_file.gid == known_file.gid or not self.check_properties) \
-                                            and (new_file.time == known_file.time or not self.check_timestamp):
-                                        # check if equal contents
-                                        if verbose > 1:
-                                            print("Comparing: %s" % new_file.path)
-                                            print("       to: %s" % known_file.path)
-                                        # check if we need to compare files or the inodes are already seen this run
-                                        if new_file.inode() in known_file.inodes and no_confirm:
-                                            logging.debug("ALREADY COMPARED")
-                                            compared = True
-                                        else:
-                                            try:
-                                                compared = filecmp.cmp(new_file.path, known_file.path, shallow=False)
-                                            except Exception as error:
-                                                compared = False
-                                                print("\nERROR: Failed to compare files: %s" % error)
-                                        if compared:
-                                            # hardlink files
-                                            if not no_confirm:
-                                                answer = input(
-                                                    "\nHardlinking:\n\n    " + known_file.path + "\n to " + new_file.path + "\n\nConfirm? [yes/No/all] ").lower()
-                                                if answer[0] == "y" or answer[0] == "a":
-                                                    ok = True
-                                                    if answer[0] == "a":
-                                                        no_confirm = True
-                                                else:
-                                                    ok = False
-                                            else:
-                                                ok = True
-                                            if ok:
-                                                update_inode, redundant_inode = known_file.hardlink(new_file, dry_run,
-                                                                                                    verbose)
-                                                if update_inode:
-                                                    self.database.update(update_inode, fingerprint)
-                                                else:
-                                                    return False
-                                                if redundant_inode:
-                                                    self.database.delete(redundant_inode, fingerprint)
-                                                else:
-                                                    # keep track of inodes hardlinked this directory
-                                                    inodes_hardlinked.append(new_file.inode())
-                                            else:
-                                                print("Skipped.")
-                                                self.database.skipped += 1
-                                            break
-                                else:
-                                    self.database.new_file(new_file, fingerprint)
+                            ok = False
+                    else:
+                        ok = True
+                    if ok:
+                        self.generation += 1
+                        self.touched[self.clusters.union((known_file.device, known_file.inode()),
+                                                         (new_file.device, new_file.inode()))] = self.generation
+                        with self.metrics.timer("linking"):
+                            update_inode, redundant_inode = known_file.hardlink(new_file, dry_run,
+                                                                                verbose, self.plan, self.linker,
+                                                                                self.events, self.database.tally)
+                        if update_inode:
+                            if (self.database.store or self.database.retained) and not dry_run:
+                                # linking changed the inode, keep the persistent database valid
+                                self.metrics.counters["stat_calls"] += 1
+                                try:
+                                    update_inode.change_time_ns = os.lstat(update_inode.path).st_ctime_ns
+                                except OSError as error:
+                                    self.report(update_inode.path, error)
+                            if dry_run:
+                                self.database.plan(update_inode)
+                            self.database.update(update_inode, fingerprint)
                         else:
-                            self.database.new_fingerprint(new_file, fingerprint)
+                            return False
+                        # the new file joined the database, as a filename of the known inode or as the source
+                        # replacing it
+                        self.database.tally.files += 1
+                        if redundant_inode:
+                            self.database.tally.inodes += 1
+                            self.database.delete(redundant_inode, fingerprint)
+                            self.database.index_file(update_inode, fingerprint, constraints,
+                                                     replace=True)
+                    else:
+                        print("Skipped.")
+                        self.database.skipped += 1
+                        if self.events is not None:
+                            self.events.skipped(new_file, known_file, "declined")
+                    return True
+                elif self.events is not None:
+                    self.events.skipped(new_file, known_file, "contents differ")
+            elif known_file is not None and known_file.inode() != new_file.inode() and self.events is not None:
+                self.events.skipped(new_file, known_file, "maximum links")
+            self.database.new_file(new_file, fingerprint)
+            # index the new file in place of a matching inode with no links to spare
+            self.database.index_file(new_file, fingerprint, constraints, replace=known_file is not None
+                                     and known_file.links >= self.maximum_links(known_file))
+        else:
+            # indexed once a second file arrives
+            self.database.new_fingerprint(new_file, fingerprint)
         return True
 
+    def prefetch(self, batch):
+        """Compute ahead, across any workers, the digests and confirmations that processing the batch will need."""
+        map_ = self.pool.map if self.pool else map
+        # groups of new files sharing fingerprint and constraints, not already hardlinked
+        groups = {}
+        for new_file in batch:
+            fingerprint = self.fingerprint(new_file)
+            if (new_file.device, new_file.inode()) not in self.database.bucket(fingerprint):
+                groups.setdefault((fingerprint, self.constraints(new_file)), []).append(new_file)
+        # sample digests where a group has other candidates
+        files = []
+        for (fingerprint, constraints), new_files in groups.items():
+            samples = self.indexed(fingerprint).get(constraints, {})
+            if len(new_files) > 1 or samples:
+                files += new_files + samples.get(None, {}).get(None, [])
+        self.hash(files, sample_digest)
+        # full digests where a sample digest is shared, comparing new groups in lockstep
+        files = []
+        lockstep = []
+        for (fingerprint, constraints), new_files in groups.items():
+            samples = self.database.index.get(fingerprint, {}).get(constraints, {})
+            shared = {}
+            for new_file in new_files:
+                shared.setdefault(self.database.cached_digests(new_file)[0], []).append(new_file)
+            for sample, new_files in shared.items():
+                digests = samples.get(sample, {})
+                if sample is None or len(new_files) == 1 and not digests:
+                    continue
+                if any(digest is not None for digest in digests) \
+                        or any(self.database.cached_digests(new_file)[1] is not None for new_file in new_files):
+                    files += new_files + digests.get(None, [])
+                else:
+                    # in slices of open files
+                    group = new_files + digests.get(None, [])
+                    for first in range(0, len(group), LOCKSTEP_FILES):
+                        lockstep.append(group[first:first + LOCKSTEP_FILES])
+        self.hash(files, content_digest)
+        if self.physical_order:
+            lockstep.sort(key=lambda group: min(self.location(file) for file in group))
+        for group, compared in zip(lockstep, map_(lambda group: attempt(compare_group, [file.path for file in group]),
+                                                  lockstep)):
+            if compared is not None:
+                digests, read = compared
+                self.metrics.counters["lockstep_comparisons"] += 1
+                self.metrics.counters["bytes_read"] += read
+                run = object()
+                for file, digest in zip(group, digests):
+                    self.database.runs[(file.device, file.inode())] = run
+                    if digest is not None:
+                        self.database.cache_digest(file, 1, digest)
+        # byte-for-byte confirmation of matches with indexed files
+        pairs = {}
+        for (fingerprint, constraints), new_files in groups.items():
+            samples = self.database.index.get(fingerprint, {}).get(constraints, {})
+            for new_file in new_files:
+                sample, digest = self.database.cached_digests(new_file)
+                known_file = samples.get(sample, {}).get(digest) if digest is not None else None
+                if known_file is not None and known_file.inode() != new_file.inode() \
+                        and not self.already_compared(new_file, known_file) \
+                        and not self.database.compared_in_lockstep(new_file, known_file):
+                    pairs[((new_file.device, new_file.inode()), (known_file.device, known_file.inode()))] = (
+                        new_file.path, known_file.path)
+                    if self.physical_order:
+                        self.location(new_file)
+        if self.physical_order:
+            pairs = dict(sorted(pairs.items(), key=lambda item: self.locations[item[0][0]]))
+        for pair, compared in zip(pairs, map_(lambda pair: attempt(compare_files, *pair), pairs.values())):
+            if compared is not None:
+                self.verified[pair], read = compared
+                self.metrics.counters["byte_comparisons"] += 1
+                self.metrics.counters["bytes_read"] += read
+
+    def already_compared(self, new_file, known_file):
+        """Whether a new file's inode is known identical to a known file this run, to link without comparing.
+        Not once watching, as the inode numbers freed by linking are reused by new files."""
+        return self.no_confirm and not self.watching and self.clusters.find((new_file.device, new_file.inode())) \
+            == self.clusters.find((known_file.device, known_file.inode()))
+
+    def hash(self, files, function):
+        """Fill the database digest cache, across any workers."""
+        stage = 0 if function is sample_digest else 1
+        pending = {}
+        for file in files:
+            self.database.recall(file)
+            if self.database.cached_digests(file)[stage] is None:
+                pending[(file.device, file.inode())] = file
+            else:
+                self.metrics.counters["digest_cache_hits"] += 1
+        if self.physical_order:
+            pending = dict(sorted(pending.items(), key=lambda item: self.location(item[1])))
+        for file, digest in zip(pending.values(), (self.pool.map if self.pool else map)(
+                lambda file: attempt(function, file.path, file.size) if stage == 0 else attempt(function, file.path),
+                pending.values())):
+            if digest is not None:
+                self.database.cache_digest(file, stage, digest)
+                self.metrics.counters["sample_digests" if stage == 0 else "content_digests"] += 1
+                self.metrics.counters["bytes_read"] += min(file.size, 3 * SAMPLE_SIZE) if stage == 0 else file.size
+
+    def location(self, file):
+        """Sort key for reading a file in physical order: the address of its first extent on its device, from
+        FIEMAP, or else its inode number, which filesystems mostly allocate in step with their blocks."""
+        key = (file.device, file.inode())
+        if key not in self.locations:
+            offset = None
+            if file.device not in self.unmapped_devices:
+                self.metrics.counters["extent_lookups"] += 1
+                try:
+                    offset = physical_offset(file.path)
+                except OSError as error:
+                    # not supported by the filesystem, rather than a file that cannot be read
+                    if error.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+                        self.unmapped_devices.add(file.device)
+            self.locations[key] = (file.device, 0, offset) if offset is not None else (file.device, 1, file.inode())
+        return self.locations[key]
+
+    def indexed(self, fingerprint):
+        """Content index of a fingerprint, built from its bucket once it is needed."""
+        if fingerprint not in self.database.index:
+            for known_file in self.database.bucket(fingerprint).values():
+                self.database.index_file(known_file, fingerprint, self.constraints(known_file))
+        return self.database.index.get(fingerprint, {})
+
+    def fingerprint(self, file):
+        """Bucket key for candidate files, partitioned by device as only files on the same device can be linked."""
+        if self.check_timestamp or self.check_properties:
+            return file.device, file.size, file.time
+        else:
+            return file.device, file.size
+
+    def maximum_links(self, file):
+        """Maximum links to an inode on the file's device."""
+        if file.device not in self.link_limits:
+            try:
+                self.link_limits[file.device] = os.pathconf(file.path, "PC_LINK_MAX")
+            except (OSError, ValueError) as error:
+                print("\nERROR: Failed to read maximum links: %s: %s" % (file.path, error))
+                self.link_limits[file.device] = DEFAULT_LINK_MAX
+        return self.link_limits[file.device]
+
+    def constraints(self, file):
+        """Attributes that must be equal, besides contents, for two files to be hardlinked."""
+        return (file.name if self.check_name else None,
+                (file.mode, file.uid, file.gid) if self.check_properties else None,
+                file.time if self.check_timestamp else None)
+
+
+def compile_patterns(patterns):
+    """Compile regular expressions, merged into one alternation where they can be: patterns with backreferences
+    are kept apart, as merging renumbers their groups."""
+    merged = [pattern for pattern in patterns if not re.search(r"\\[1-9]|\(\?P=", pattern)]
+    separate = [pattern for pattern in patterns if pattern not in merged]
+    try:
+        compiled = [re.compile("|".join("(?:%s)" % pattern for pattern in merged))] if merged else []
+    except re.error:
+        # such as inline flags, allowed only at the start of a pattern
+        compiled = [re.compile(pattern) for pattern in merged]
+    return compiled + [re.compile(pattern) for pattern in separate]
+
+
+def read_patterns(filename):
+    """Shell patterns from an ignore file, one per line, skipping blank lines and # comments."""
+    with open(filename) as file:
+        return [line.strip() for line in file if line.strip() and not line.startswith("#")]
+
+
+def sample_digest(path, size):
+    """Digest of the head, middle and tail blocks of a file, or of the whole of a small file."""
+    digest = hashlib.blake2b()
+    with open(path, "rb") as file:
+        if size <= 3 * SAMPLE_SIZE:
+            digest.update(file.read())
+        else:
+            for offset in (0, (size - SAMPLE_SIZE) // 2, size - SAMPLE_SIZE):
+                file.seek(offset)
+                digest.update(file.read(SAMPLE_SIZE))
+    return digest.digest()
+
+
+def content_digest(path):
+    """Digest of the full contents of a file, holes hashed as zeros without reading them."""
+    digest = hashlib.blake2b()
+    with SparseFile(path) as file:
+        for offset in range(0, file.size, CHUNK_SIZE):
+            digest.update(file.read(offset, CHUNK_SIZE))
+    return digest.digest()
+
+
+def compare_files(first, second):
+    """Compare two files byte for byte, reading only where either has data: holes in both are equal, and a hole in
+    one must be zeros in the other. Returns whether they are equal, and the bytes read."""
+    with SparseFile(first) as file, SparseFile(second) as other:
+        if file.size != other.size:
+            return False, 0
+        # union of the data extents of both
+        extents = []
+        for start, end in sorted(file.extents + other.extents):
+            if extents and start <= extents[-1][1]:
+                extents[-1][1] = max(extents[-1][1], end)
+            else:
+                extents.append([start, end])
+        for start, end in extents:
+            for offset in range(start, end, CHUNK_SIZE):
+                length = min(CHUNK_SIZE, end - offset)
+                if file.read(offset, length) != other.read(offset, length):
+                    return False, file.read_bytes + other.read_bytes
+        return True, file.read_bytes + other.read_bytes
+
+
+def data_extents(descriptor, size):
+    """Ranges of a file holding data, from SEEK_DATA and SEEK_HOLE, the rest being holes; the whole file where
+    the filesystem does not report holes."""
+    if not hasattr(os, "SEEK_DATA"):
+        return [(0, size)]
+    extents = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(descriptor, offset, os.SEEK_DATA)
+        except OSError as error:
+            # a hole to the end
+            if error.errno == errno.ENXIO:
+                break
+            if error.errno in (errno.EINVAL, errno.EOPNOTSUPP):
+                return [(0, size)]
+            raise
+        if start >= size:
+            break
+        end = min(os.lseek(descriptor, start, os.SEEK_HOLE), size)
+        extents.append((start, end))
+        offset = end
+    return extents
+
+
+class SparseFile:
+    """Defines a file read by position, reading only its data extents and the holes between them as zeros."""
+
+    def __init__(self, path):
+        self.descriptor = os.open(path, os.O_RDONLY)
+        try:
+            self.size = os.fstat(self.descriptor).st_size
+            self.extents = data_extents(self.descriptor, self.size)
+        except OSError:
+            os.close(self.descriptor)
+            raise
+        self.starts = [start for start, end in self.extents]
+        self.read_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *arguments):
+        self.close()
+
+    def read(self, offset, length):
+        """Bytes of a range, cut short where the file ends or has shrunk."""
+        length = max(0, min(length, self.size - offset))
+        index = max(0, bisect.bisect_right(self.starts, offset) - 1)
+        # within one extent
+        if index < len(self.extents) and self.extents[index][0] <= offset \
+                and offset + length <= self.extents[index][1]:
+            data = os.pread(self.descriptor, length, offset)
+            self.read_bytes += len(data)
+            return data
+        data = bytearray(length)
+        while index < len(self.extents) and self.extents[index][0] < offset + length:
+            start = max(self.extents[index][0], offset)
+            end = min(self.extents[index][1], offset + length)
+            if start < end:
+                chunk = os.pread(self.descriptor, end - start, start)
+                self.read_bytes += len(chunk)
+                data[start - offset:start - offset + len(chunk)] = chunk
+                if len(chunk) < end - start:
+                    return bytes(data[:start - offset + len(chunk)])
+            index += 1
+        return bytes(data)
+
+    def close(self):
+        os.close(self.descriptor)
+
+
+def physical_offset(path):
+    """Physical address of the first extent of a file, from the FIEMAP ioctl, or None where no extent is mapped."""
+    request = bytearray(struct.pack(FIEMAP_HEADER, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)) + bytearray(FIEMAP_EXTENT_SIZE)
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        fcntl.ioctl(descriptor, FS_IOC_FIEMAP, request)
+    finally:
+        os.close(descriptor)
+    if not struct.unpack_from(FIEMAP_HEADER, request)[3]:
+        return None
+    return struct.unpack_from("=QQ", request, struct.calcsize(FIEMAP_HEADER))[1]
+
+
+def list_directory(directory):
+    """List directory entries in a worker, with file status cached on each entry."""
+    assert os.path.isdir(directory)
+    with os.scandir(directory) as directory_entries:
+        directory_entries = list(directory_entries)
+    for directory_entry in directory_entries:
+        try:
+            if not directory_entry.is_symlink() and not directory_entry.is_dir():
+                directory_entry.stat(follow_symlinks=False)
+        except OSError:
+            pass
+    return directory_entries
+
+
+def compare_group(paths):
+    """Compare files of equal size together, reading them in lockstep chunks and splitting the group where chunks
+    differ, so each byte is read once and a file drops out at its first block unlike any other. Holes are read as
+    zeros without reading them.
+    Returns the content digest of each file still matching another at the end, or None, and the bytes read."""
+    digests = [None] * len(paths)
+    # bounded read buffer
+    chunk_size = max(SAMPLE_SIZE, min(CHUNK_SIZE, LOCKSTEP_BUFFER // max(1, len(paths))))
+    files = []
+    offset = 0
+    try:
+        for path in paths:
+            files.append(SparseFile(path))
+        groups = [(list(range(len(paths))), hashlib.blake2b())]
+        while groups:
+            split = []
+            for members, digest in groups:
+                chunks = {}
+                for index in members:
+                    chunks.setdefault(files[index].read(offset, chunk_size), []).append(index)
+                for chunk, members in chunks.items():
+                    if len(members) == 1:
+                        continue
+                    if not chunk:
+                        for index in members:
+                            digests[index] = digest.digest()
+                        continue
+                    group_digest = digest.copy() if len(chunks) > 1 else digest
+                    group_digest.update(chunk)
+                    split.append((members, group_digest))
+            groups = split
+            offset += chunk_size
+    finally:
+        for file in files:
+            file.close()
+    return digests, sum(file.read_bytes for file in files)
+
+
+def process_shard(options, shard, journal, verbose=0, dry_run=False, release=False):
+    """Hardlink a range of file sizes in a worker process, without confirmation. Returns the database, with its
+    files unless released, the links made, and whether the shard completed."""
+    check_name, check_timestamp, check_properties, jobs, physical_order, attributes = options
+    search = Search([], None, [], 0, 0, check_name, check_timestamp, check_properties, jobs,
+                    linker=Linker(journal), physical_order=physical_order)
+    search.no_confirm = True
+    if attributes is not None:
+        search.database.attributes = Attributes(search.metrics, attributes)
+    if jobs > 1:
+        search.pool = concurrent.futures.ThreadPoolExecutor(jobs)
+    try:
+        with search.linker:
+            completed = search.process_sizes(shard, verbose, dry_run, release)
+    finally:
+        if search.pool:
+            search.pool.shutdown()
+    search.database.index.clear()
+    search.database.digests.clear()
+    return search.database, search.linker.links, completed
+
+
+def signed(number):
+    """Two's complement of an unsigned 64-bit number, for packing inode numbers into signed arrays."""
+    return number - (1 << 64) if number >= (1 << 63) else number
+
+
+def unsigned(number):
+    return number % (1 << 64)
+
+
+def attempt(function, *arguments, **keywords):
+    """Call a function in a worker, returning None on failure so the error is reported when it is retried in order."""
+    try:
+        return function(*arguments, **keywords)
+    except OSError:
+        return None
+
 
 def strip_invalid_characters(text):
     return str(text.encode("utf-8", "ignore"))
@@ -471,6 +2392,53 @@ def human(number):
     return "%d B" % number
 
 
+def scan(directories, dry_run=False, database=None, matching=None, excluding=(), ignoring=(), minimum_size=0,
+         maximum_size=0, check_name=False, check_timestamp=False, check_properties=False, jobs=1, depth_first=False,
+         physical_order=False):
+    """Scan directories and hardlink identical files without confirmation, as a library.
+    Options are those of the command line. Generates the events of each file linked (or planned in a dry run),
+    found already hardlinked, skipped, or failing, as dicts of Events.FIELDS, while the scan runs in a thread.
+    A Database passed to later calls in the same process is reused, keeping its files unchanged on disk since,
+    so they are not read again. Closing the generator early stops the scan after the file in hand."""
+    directories = [os.path.abspath(os.path.expanduser(directory)) for directory in directories]
+    for directory in directories:
+        if not os.path.isdir(directory):
+            raise NotADirectoryError("%s is not a directory" % directory)
+    events = EventQueue()
+    search = Search(directories, matching, list(excluding), minimum_size, maximum_size, check_name, check_timestamp,
+                    check_properties, jobs, depth_first, events=events, ignoring=ignoring,
+                    physical_order=physical_order, database=database)
+    search.database.renew(search.fingerprint)
+    search.metrics = search.database.metrics
+    failure = []
+
+    def run():
+        try:
+            with search.linker:
+                search.scan(0, dry_run, True)
+        except BaseException as error:
+            failure.append(error)
+        finally:
+            events.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        for record in iter(events.queue.get, None):
+            yield record
+    finally:
+        # drain to let an early stop through
+        search.stopped = True
+        while thread.is_alive():
+            try:
+                events.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        thread.join()
+    if failure:
+        raise failure[0]
+
+
 def parse_command_line(version, install_path):
     description = "%(prog)s version " + version + ". " \
                   + "Scan for and hardlink identical files. https://github.com/wolfospealain/hardlinkpy"
@@ -478,22 +2446,59 @@ def parse_command_line(version, install_path):
     if ".py" in sys.argv[0]:
         parser.add_argument("--install", action="store_true", dest="install", default=False,
                             help="install to Linux destination path (default: " + install_path + ")")
-    parser.add_argument("-d", "--database", help="experimental: use persistent database file (hardlink.db)",
+    parser.add_argument("-a", "--apply", metavar="FILE",
+                        help="link files from a plan written with --plan, skipping any changed since",
+                        action="store", dest="apply", default=None)
+    parser.add_argument("-c", "--checkpoint", type=int, metavar="SECONDS",
+                        help="checkpoint the scan to hardlink.checkpoint every SECONDS, to continue with --resume "
+                             "if interrupted (not with -e, -J, -O, -W or -w)",
+                        action="store", dest="checkpoint", default=None)
+    parser.add_argument("-C", "--digest-cache",
+                        help="keep content digests in a user extended attribute of each inode, trusted while its size "
+                             "and modification time are unchanged (not written with -n)",
+                        action="store_true", dest="digest_cache", default=False)
+    parser.add_argument("-D", "--depth-first", help="scan directories one at a time in depth-first order with --jobs",
+                        action="store_true", dest="depth_first", default=False)
+    parser.add_argument("-d", "--database", help="use persistent database file (hardlink.db)",
                         action="store_true", dest="persistent")
+    parser.add_argument("-i", "--incremental",
+                        help="skip directories unchanged since the last run with -d and the same file options, "
+                             "not a dry run",
+                        action="store_true", dest="incremental", default=False)
+    parser.add_argument("-e", "--events", metavar="FILE",
+                        help="stream link, skip and error events and already hardlinked files to FILE as they happen "
+                             "(- for stdout, with other output on stderr)",
+                        action="store", dest="events", default=None)
+    parser.add_argument("-F", "--format", help="events format (default: jsonl)", choices=("jsonl", "csv"),
+                        action="store", dest="format", default="jsonl")
     parser.add_argument("-f", "--filenames-equal", help="filenames have to be identical", action="store_true",
                         dest="check_name", default=False)
     parser.add_argument("-l", "--log", help="debugging mode (log to hardlink.log)", action="store_true", dest="log",
                         default=False)
+    parser.add_argument("-M", "--metrics", metavar="FILE", help="write run counters and phase timings to FILE as JSON",
+                        action="store", dest="metrics", default=None)
     parser.add_argument("-n", "--dry-run", help="dry-run only, no changes to files", action="store_true",
                         dest="dry_run", default=False)
     parser.add_argument("-p", "--print-previous", help="output list of previously created hardlinks",
                         action="store_true", dest="previous", default=False)
     parser.add_argument("-P", "--properties", help="file properties have to match", action="store_true",
                         dest="check_properties", default=False)
+    parser.add_argument("-R", "--physical-order",
+                        help="collect candidate files across directories, then read their contents in the order of "
+                             "their location on disk (FIEMAP, or inode number), for rotational storage",
+                        action="store_true", dest="physical_order", default=False)
     parser.add_argument("-q", "--no-stats", help="skip printing statistics", action="store_false", dest="statistics",
                         default=True)
+    parser.add_argument("-O", "--out-of-core",
+                        help="list the whole tree to sorted temporary files first (in TMPDIR), then process one file "
+                             "size at a time, with memory bounded by the largest size (not with -o or -p)",
+                        action="store_true", dest="out_of_core", default=False)
     parser.add_argument("-o", "--output", help="output list of hardlinked files", action="store_true", dest="output",
                         default=False)
+    parser.add_argument("-r", "--resume",
+                        help="continue an interrupted scan from hardlink.checkpoint, with the same directories and "
+                             "options, checkpointing as it goes (every %i seconds unless -c)" % CHECKPOINT_INTERVAL,
+                        action="store_true", dest="resume", default=False)
     parser.add_argument("-s", "--min-size", type=int, help="minimum file size", action="store", dest="minimum_size",
                         default=0)
     parser.add_argument("-S", "--max-size", type=int, help="maximum file size", action="store", dest="maximum_size",
@@ -502,9 +2507,27 @@ def parse_command_line(version, install_path):
                         dest="check_timestamp", default=False)
     parser.add_argument("-v", "--verbose", help="verbosity level (0, 1 default, 2, 3)", metavar="LEVEL", action="store",
                         dest="verbose", type=int, default=1)
+    parser.add_argument("-W", "--watch",
+                        help="after the scan, keep hardlinking files as they are written or moved into the directories "
+                             "(Linux inotify), until interrupted (not with -O)",
+                        action="store_true", dest="watch", default=False)
+    parser.add_argument("-w", "--plan", metavar="FILE",
+                        help="write a plan of the links to make to FILE (dry-run without confirmation)",
+                        action="store", dest="plan", default=None)
+    parser.add_argument("-X", "--exclude-from", metavar="FILE",
+                        help="ignore file of shell patterns matching names to exclude, one per line, "
+                             "with a trailing / for directories only (may specify multiple times)",
+                        action="append", dest="ignore_files", default=[])
     parser.add_argument("-x", "--exclude", metavar="REGEX",
                         help="regular expression used to exclude files/dirs (may specify multiple times)",
                         action="append", dest="excluding", default=[])
+    parser.add_argument("-J", "--processes", type=int,
+                        help="worker processes, each hardlinking a range of file sizes on one filesystem, listed "
+                             "first as with -O (with -Y, not with -d, -e, -w or -W; default: 1)",
+                        metavar="N", action="store", dest="processes", default=1)
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="parallel directory scanning, hashing and comparison workers (default: 1)",
+                        metavar="N", action="store", dest="jobs", default=1)
     parser.add_argument("-m", "--match", help="shell pattern used to match files", metavar="PATTERN", action="store",
                         dest="matching", default=None)
     parser.add_argument("-Y", "--no-confirm",
@@ -513,7 +2536,47 @@ def parse_command_line(version, install_path):
                         dest="no_confirm", default=False)
     parser.add_argument("directories", help="one or more search directories", nargs='*')
     args = parser.parse_args()
-    if args.directories:
+    if args.incremental and not args.persistent:
+        print("ERROR: --incremental requires a persistent database (--database)")
+        sys.exit(1)
+    if args.out_of_core and (args.output or args.previous):
+        print("ERROR: --out-of-core does not keep the files in memory for --output or --print-previous, "
+              "use --events")
+        sys.exit(1)
+    if args.watch and (args.out_of_core or args.apply):
+        print("ERROR: --watch keeps the files scanned in memory, not with --out-of-core or --apply")
+        sys.exit(1)
+    if (args.checkpoint is not None or args.resume) \
+            and (args.events or args.processes > 1 or args.out_of_core or args.watch or args.plan or args.apply):
+        print("ERROR: --checkpoint and --resume continue the scan alone, not with --events, --processes, "
+              "--out-of-core, --watch, --plan or --apply")
+        sys.exit(1)
+    if args.processes > 1 and (not args.no_confirm or args.persistent or args.events or args.plan or args.watch):
+        print("ERROR: --processes links without confirmation (--no-confirm), not with --database, --events, --plan "
+              "or --watch")
+        sys.exit(1)
+    args.ignoring = []
+    for filename in args.ignore_files:
+        try:
+            args.ignoring += read_patterns(filename)
+        except OSError as error:
+            print("ERROR: %s" % error)
+            sys.exit(1)
+    for pattern in args.excluding:
+        try:
+            re.compile(pattern)
+        except re.error as error:
+            print("ERROR: invalid --exclude %s: %s" % (pattern, error))
+            sys.exit(1)
+    if args.plan:
+        args.dry_run = True
+        args.no_confirm = True
+    if args.apply:
+        if args.directories or args.plan:
+            print("ERROR: --apply takes no search directories or --plan")
+            sys.exit(1)
+        directories = []
+    elif args.directories:
         directories = [os.path.abspath(os.path.expanduser(directory)) for directory in args.directories]
         for directory in directories:
             if not os.path.isdir(directory):
@@ -550,6 +2613,8 @@ def main():
     install_path = "/usr/local/bin"
     db_filename = "./hardlink.db"
     debug_filename = "./hardlink.log"
+    journal_filename = "./hardlink.journal"
+    checkpoint_filename = "./hardlink.checkpoint"
     args, directories = parse_command_line(version, install_path)
     if ".py" in sys.argv[0]:
         if args.install:
@@ -558,25 +2623,97 @@ def main():
     if args.log:
         logging.basicConfig(filename=debug_filename, level=logging.DEBUG)
         args.excluding.append(debug_filename)
+    linker = Linker(journal_filename)
+    if not args.dry_run:
+        linker.recover()
+        # left by worker processes
+        for filename in sorted(glob.glob(glob.escape(journal_filename) + ".*")):
+            Linker(filename).recover()
+    if args.apply:
+        with linker:
+            linked, skipped = Plan(args.apply).apply(linker, args.verbose)
+        if args.statistics:
+            print("\nPlan applied: %i links made, %i skipped" % (linked, skipped))
+        return
+    args.excluding.append("^%s$" % re.escape(os.path.abspath(journal_filename)))
     if args.persistent:
         args.excluding.append(db_filename)
-    search = Search(directories, args.matching, args.excluding, args.minimum_size, args.maximum_size,
-                    args.check_name, args.check_timestamp, args.check_properties)
-    if args.persistent:
-        search.database.load(db_filename)
-    if search.scan(args.verbose, args.dry_run, args.no_confirm):
-        if args.previous:
-            print(search.database.report_linked())
-        if args.output:
-            print(search.database.report_links())
-        if args.statistics:
-            print(search.database.statistics(args.dry_run))
+    plan = Plan(args.plan) if args.plan else None
+    if plan:
+        args.excluding.append("^%s$" % re.escape(os.path.abspath(args.plan)))
+    events = Events(args.events, args.format) if args.events else None
+    # with events on standard output, everything else goes to standard error
+    with contextlib.redirect_stdout(sys.stderr) if args.events == "-" else contextlib.nullcontext():
+        if args.events and args.events != "-":
+            args.excluding.append("^%s$" % re.escape(os.path.abspath(args.events)))
+        checkpoint = None
+        if args.checkpoint is not None or args.resume:
+            checkpoint = Checkpoint(checkpoint_filename,
+                                    CHECKPOINT_INTERVAL if args.checkpoint is None else args.checkpoint)
+            args.excluding.append("^%s(\\.tmp)?$" % re.escape(os.path.abspath(checkpoint_filename)))
+        watcher = None
+        if args.watch:
+            try:
+                watcher = Watcher()
+            except (OSError, AttributeError) as error:
+                print("ERROR: --watch requires Linux inotify: %s" % error)
+                sys.exit(1)
+        search = Search(directories, args.matching, args.excluding, args.minimum_size, args.maximum_size,
+                        args.check_name, args.check_timestamp, args.check_properties, args.jobs, args.depth_first,
+                        args.incremental, plan, linker, events, args.ignoring, args.out_of_core, args.physical_order,
+                        watcher=watcher, processes=args.processes, checkpoint=checkpoint)
+        if args.resume:
+            try:
+                search.resume(args.dry_run)
+            except FileNotFoundError:
+                print("ERROR: no checkpoint to resume from (%s)" % checkpoint_filename)
+                sys.exit(1)
+            except (OSError, ValueError, pickle.UnpicklingError) as error:
+                print("ERROR: %s" % error)
+                sys.exit(1)
         if args.persistent:
-            search.database.save(db_filename)
-    if args.dry_run:
-        print("\nDRY RUN ONLY: No files were changed.\n")
-    if args.log:
-        logging.info(search.database.statistics(args.dry_run))
+            try:
+                search.database.load(db_filename)
+            except sqlite3.DatabaseError as error:
+                print("ERROR: %s: %s" % (db_filename, error))
+                sys.exit(1)
+        if args.digest_cache:
+            search.database.attributes = Attributes(search.metrics, not args.dry_run)
+        try:
+            with linker:
+                completed = search.scan(args.verbose, args.dry_run, args.no_confirm)
+                if completed and watcher:
+                    completed = search.watch(args.verbose, args.dry_run)
+            if completed and checkpoint:
+                checkpoint.remove()
+        finally:
+            # changes are written through as the scan goes, so keep them even if interrupted
+            if args.persistent:
+                search.database.save(db_filename)
+            if plan:
+                plan.close()
+            if events:
+                events.close()
+        if completed:
+            if args.previous:
+                for text in search.database.report_linked():
+                    print(text, end="")
+                print()
+            if args.output:
+                for text in search.database.report_links():
+                    print(text, end="")
+                print()
+            if args.statistics:
+                print(search.database.statistics())
+        if plan:
+            print("\nPLAN WRITTEN: %i entries to %s, apply with --apply.\n" % (plan.entries, args.plan))
+        elif args.dry_run:
+            print("\nDRY RUN ONLY: No files were changed.\n")
+        if args.metrics:
+            search.metrics.save(args.metrics)
+        if args.log:
+            logging.debug("DATABASE %s", search.database.text_dump())
+            logging.info(search.database.statistics())
 
 
 if __name__ == '__main__':